@@ -8,6 +8,9 @@ from cmd_update import cmd_update
 from cmd_install import cmd_install
 from cmd_remove import cmd_remove
 from cmd_list import cmd_list
+from cmd_switch import cmd_switch
+from cmd_mirror import cmd_mirror_delta, cmd_mirror_index
+from cmd_gc import cmd_gc_archive, cmd_gc_compress, cmd_gc_dedup, cmd_gc_remove
 
 ROOT = Path('/bold')
 
@@ -24,6 +27,7 @@ def main():
 
     parser_install = subparsers.add_parser('install')
     parser_install.add_argument('app', nargs='+', help='Name of the app(s) to install')
+    parser_install.add_argument('-j', '--jobs', type=int, help='Packages to install in parallel (default: `installJobs` in config, or 4)')
     # parser_install.add_argument('-q', '--queue', action='store_true', help='Finish install on next `bold switch`')
     parser_install.set_defaults(func=cmd_install)
 
@@ -34,6 +38,7 @@ def main():
 
     parser_update = subparsers.add_parser('update')
     parser_update.add_argument('app', nargs='*', help='Name of the app(s) to update')
+    parser_update.add_argument('-j', '--jobs', type=int, help='Packages to install in parallel (default: `installJobs` in config, or 4)')
     # parser_update.add_argument('-q', '--queue', action='store_true', help='Finish update on next `bold switch`')
     # parser_update.add_argument('-c', '--check', action='store_true', help='Check for updates, but don\'t install them')
     # parser_update.add_argument('-n', '--no-reload', action='store_true', help='Don\'t reload services')
@@ -55,6 +60,7 @@ def main():
     parser_list.add_argument('-i', '--installed', action='store_true', help='Only show installed packages')
     parser_list.add_argument('-m', '--manually', action='store_true', help='Only show manually installed packages')
     parser_list.add_argument('-1', '--lines', action='store_true', help='One package per line, no description')
+    parser_list.add_argument('-f', '--files', action='store_true', help='List the files of each package')
     parser_list.add_argument('app', nargs='?', help='Name of the app to get info about')
     parser_list.set_defaults(func=cmd_list)
 
@@ -64,9 +70,11 @@ def main():
     parser_hack.set_defaults(func=cmd_hack)
 
     parser_switch = subparsers.add_parser('switch')
-    parser_switch.add_argument('generation', help='Generation ID to switch to')
+    parser_switch.add_argument('generation', nargs='?', help='Generation ID to switch to (leave empty to list them)')
     parser_switch.add_argument('-r', '--on-reboot', action='store_true', help='Switch on next reboot')
-    parser_switch.set_defaults(func=unimplemented)
+    parser_switch.add_argument('--boot', action='store_true', help='Apply a switch staged with `--on-reboot` (run during boot)')
+    parser_switch.add_argument('-j', '--jobs', type=int, help='Packages to restore in parallel for cold snapshots (default: `installJobs` in config, or 4)')
+    parser_switch.set_defaults(func=cmd_switch)
 
     parser_gc = subparsers.add_parser('gc')
     parser_gc.set_defaults(func=unimplemented)
@@ -75,14 +83,38 @@ def main():
     parser_gc_remove = subparsers_gc.add_parser('remove')
     parser_gc_remove.add_argument('-o', '--older-than', help='Remove generations older than... (units: h/d/w/m/y)')
     parser_gc_remove.add_argument('generation', nargs='*', help='Remove specific generation(s)')
+    parser_gc_remove.add_argument('-n', '--dry-run', action='store_true', help='Only report what would be removed')
+    parser_gc_remove.add_argument('-k', '--keep-archives', action='store_true', help='Keep unreferenced bincache archives')
+    parser_gc_remove.add_argument('-j', '--jobs', type=int, help='Paths to delete in parallel (default: CPU count)')
+    parser_gc_remove.set_defaults(func=cmd_gc_remove)
 
     parser_gc_compress = subparsers_gc.add_parser('compress')
     parser_gc_compress.add_argument('-o', '--older-than', help='Compress generations older than... (units: h/d/w/m/y)')
     parser_gc_compress.add_argument('generation', nargs='*', help='Compress specific generation(s)')
+    parser_gc_compress.add_argument('-j', '--jobs', type=int, help='Packages to pack in parallel (default: CPU count)')
+    parser_gc_compress.set_defaults(func=cmd_gc_compress)
 
     parser_gc_archive = subparsers_gc.add_parser('archive')
     parser_gc_archive.add_argument('-o', '--older-than', help='Archive generations older than... (units: h/d/w/m/y)')
     parser_gc_archive.add_argument('generation', nargs='*', help='Archive specific generation(s)')
+    parser_gc_archive.add_argument('-j', '--jobs', type=int, help='Packages to pack in parallel (default: CPU count)')
+    parser_gc_archive.set_defaults(func=cmd_gc_archive)
+
+    parser_gc_dedup = subparsers_gc.add_parser('dedup')
+    parser_gc_dedup.add_argument('-j', '--jobs', type=int, help='Files to hash in parallel (default: CPU count)')
+    parser_gc_dedup.set_defaults(func=cmd_gc_dedup)
+
+    parser_mirror = subparsers.add_parser('mirror')
+    subparsers_mirror = parser_mirror.add_subparsers(dest='action', required=True)
+
+    parser_mirror_index = subparsers_mirror.add_parser('index')
+    parser_mirror_index.add_argument('dir', nargs='?', help='Binary cache directory (default: local bincache)')
+    parser_mirror_index.set_defaults(func=cmd_mirror_index)
+
+    parser_mirror_delta = subparsers_mirror.add_parser('delta')
+    parser_mirror_delta.add_argument('-b', '--bases', type=int, default=3, help='Older versions to diff each package against')
+    parser_mirror_delta.add_argument('dir', nargs='?', help='Binary cache directory (default: local bincache)')
+    parser_mirror_delta.set_defaults(func=cmd_mirror_delta)
 
     # ---------
 
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import zstandard
+
+from manifests import ManifestEntry
+from store import ContentStore
+from utils import CHUNK_SIZE
+
+# unix time 946684800 == 2000-01-01 00:00:00
+REPRODUCIBLE_MTIME = 946684800
+DEFAULT_PACK_LEVEL = 10
+
+
+def staging_dir(root: Path, name: str) -> Path:
+    # Staging directories live on the same filesystem as `/bold/app`, so they can be renamed into place
+    staging = root / 'app' / '.staging'
+    staging.mkdir(parents=True, exist_ok=True)
+    path = Path(tempfile.mkdtemp(prefix=f'{name}.', dir=staging))
+    path.chmod(0o755)
+    return path
+
+
+def _extract_file(tar: tarfile.TarFile, member: tarfile.TarInfo, dest_dir: Path) -> str:
+    # Like `tar.extract` for a regular file, returns the sha256 of its contents
+    dest = dest_dir / member.name
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    src = tar.extractfile(member)
+    digest = hashlib.sha256()
+    with dest.open('wb') as f:
+        while data := src.read(CHUNK_SIZE):
+            digest.update(data)
+            f.write(data)
+    os.chmod(dest, member.mode)
+    os.utime(dest, (member.mtime, member.mtime))
+    return digest.hexdigest()
+
+
+def extract_archive(stream: BinaryIO, root: Path, package: str,
+                    store: Optional[ContentStore] = None) -> List[ManifestEntry]:
+    # Decompress and untar a `.tar.zst` stream in a single pass, and atomically move the result to `/bold/app`.
+    # If `store` is given, regular files are hardlinked from the content store instead of written again.
+    # Returns the package's manifest, files are hashed as they're extracted.
+    staging = staging_dir(root, package)
+    entries: Dict[str, ManifestEntry] = {}
+    symlinks = []
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(stream, read_size=CHUNK_SIZE, closefd=False) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                # Same semantics as `tar -xf`, archives come from our own bincache
+                if hasattr(tarfile, 'fully_trusted_filter'):
+                    tar.extraction_filter = tarfile.fully_trusted_filter
+                for member in tar:
+                    path = os.path.normpath(member.name)
+                    if member.isreg():
+                        if store is None:
+                            digest = _extract_file(tar, member, staging)
+                        else:
+                            digest = store.extract_file(tar, member, staging)
+                        entries[path] = ManifestEntry('f', member.size, digest, path)
+                        continue
+
+                    tar.extract(member, staging)
+                    if member.isdir():
+                        entries[path] = ManifestEntry('d', 0, '', path)
+                    elif member.issym():
+                        # Whether it's a link to a directory is only known once everything is in place
+                        symlinks.append((path, member.linkname))
+                    elif member.islnk():
+                        entries[path] = entries[os.path.normpath(member.linkname)]._replace(path=path)
+                    else:
+                        entries[path] = ManifestEntry('f', 0, hashlib.sha256().hexdigest(), path)
+
+        # The tar reader stops at the end-of-archive marker, read the rest so downloads complete (and get verified)
+        while stream.read(CHUNK_SIZE):
+            pass
+
+        os.rename(staging, root / 'app' / package)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    for path, target in symlinks:
+        entries[path] = ManifestEntry('L' if os.path.isdir(root / 'app' / package / path) else 'l', 0, target, path)
+    entries.pop('.', None)
+    return sorted(entries.values(), key=lambda entry: entry.path)
+
+
+def write_reproducible_tar(src: Path, fileobj: BinaryIO):
+    # Same layout as `tar --sort=name --mtime=@946684800 --owner=0 --group=0 --numeric-owner -cf - -C src .`
+    with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+        def add(path: str, arcname: str):
+            info = tar.gettarinfo(path, arcname)
+            info.mtime = REPRODUCIBLE_MTIME
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            if info.isreg():
+                with open(path, 'rb') as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
+
+            if info.isdir():
+                for name in sorted(os.listdir(path)):
+                    add(os.path.join(path, name), f'{arcname}/{name}')
+
+        add(str(src), '.')
+
+
+class _CountingWriter:
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+
+def pack_archive(src: Path, dest: Path, level: int = DEFAULT_PACK_LEVEL, threads: int = 0,
+                 long_distance: bool = False) -> Tuple[int, int]:
+    # Reproducible `.tar.zst` of `src`, compressed on `threads` worker threads (0 compresses in the calling thread).
+    # Written next to `dest` and renamed into place, returns the uncompressed and compressed sizes.
+    params = zstandard.ZstdCompressionParameters.from_level(level, threads=threads, enable_ldm=long_distance)
+    compressor = zstandard.ZstdCompressor(compression_params=params)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{dest.name}.', dir=dest.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with compressor.stream_writer(f, closefd=False) as writer:
+                counter = _CountingWriter(writer)
+                write_reproducible_tar(src, counter)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, dest)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return counter.size, dest.stat().st_size
@@ -0,0 +1,374 @@
+import contextlib
+import hashlib
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Dict, List, NamedTuple, Optional
+
+import zstandard
+
+from utils import hash_file
+
+# Consecutive failures before a mirror is skipped for the rest of the run
+MAX_FAILURES = 3
+# Used to weigh latency against throughput when ranking mirrors
+TYPICAL_DOWNLOAD_SIZE = 4 * 1024 * 1024
+# Transfers smaller than this don't say much about throughput
+MIN_METERED_SIZE = 256 * 1024
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MISSING_STATUSES = (404, 410)
+# Sorted, zstd compressed TSV of `<name>@<hash>\t<size>\t<sha256>\t<comma separated delta base hashes>`
+INDEX_NAME = 'index.tsv.zst'
+
+
+class IndexEntry(NamedTuple):
+    size: int
+    sha256: str
+    deltas: frozenset
+
+
+class BincacheError(OSError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class VerificationError(BincacheError):
+    pass
+
+
+def write_index(bincache_dir: Path) -> int:
+    lines = []
+    for archive in sorted(bincache_dir.glob('*@*.tar.zst')):
+        package = archive.name[:-len('.tar.zst')]
+        deltas = sorted(delta.name[:-len('.zst')] for delta in (bincache_dir / 'deltas' / package).glob('*.zst'))
+        lines.append(f'{package}\t{archive.stat().st_size}\t{hash_file(archive)}\t{",".join(deltas)}\n')
+
+    tmp_index = bincache_dir / f'.{INDEX_NAME}.tmp'
+    tmp_index.write_bytes(zstandard.ZstdCompressor(level=19).compress(''.join(lines).encode()))
+    tmp_index.rename(bincache_dir / INDEX_NAME)
+    return len(lines)
+
+
+def parse_index(data: bytes) -> Dict[str, IndexEntry]:
+    index = {}
+    for line in zstandard.ZstdDecompressor().decompressobj().decompress(data).decode().splitlines():
+        package, size, sha256, deltas = line.split('\t')
+        index[package] = IndexEntry(int(size), sha256, frozenset(deltas.split(',')) if deltas else frozenset())
+    return index
+
+
+def _sidecar_path(partial: Path) -> Path:
+    return partial.with_name(f'{partial.name}.json')
+
+
+def discard_partial(partial: Path):
+    partial.unlink(missing_ok=True)
+    _sidecar_path(partial).unlink(missing_ok=True)
+
+
+class _ResumedStream:
+    # The whole file: bytes from an earlier interrupted transfer first, then the rest from the network.
+    # Network bytes are appended to the partial file, and the result is verified when the end is reached.
+    def __init__(self, previous: Optional[BinaryIO], response, partial_file: BinaryIO, sidecar: Dict):
+        self.previous = previous
+        self.response = response
+        self.partial_file = partial_file
+        self.sidecar = sidecar
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = b''
+        if self.previous is not None:
+            data = self.previous.read(size)
+            if not data:
+                self.previous = None
+        if not data and self.response is not None:
+            data = self.response.read(size)
+            self.partial_file.write(data)
+
+        if data:
+            self.size += len(data)
+            self.digest.update(data)
+        else:
+            self._verify()
+        return data
+
+    def _verify(self):
+        self.partial_file.flush()
+        if self.sidecar['size'] is not None and self.size < self.sidecar['size']:
+            # Interrupted, can be resumed
+            raise BincacheError(f'{self.sidecar["url"]}: Transfer interrupted after {self.size} bytes')
+        if self.sidecar['size'] is not None and self.size != self.sidecar['size']:
+            raise VerificationError(f'{self.sidecar["url"]}: Expected {self.sidecar["size"]} bytes, got {self.size}')
+        if self.sidecar['sha256'] is not None and self.digest.hexdigest() != self.sidecar['sha256']:
+            raise VerificationError(f'{self.sidecar["url"]}: Digest mismatch')
+
+
+class _MeteredResponse:
+    # Counts the bytes read from a response, to estimate the mirror's throughput
+    def __init__(self, response):
+        self.response = response
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        # `HTTPResponse.read(-1)` reads until the socket is closed, which breaks keep-alive
+        data = self.response.read(size if size >= 0 else None)
+        self.bytes_read += len(data)
+        return data
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    @property
+    def status(self):
+        return self.response.status
+
+
+class Mirror:
+    def __init__(self, url: str, timeout: float):
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url.rstrip('/')
+        self.host = parsed.hostname
+        self.timeout = timeout
+        self.latency: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.failures = 0
+        self.broken = False
+        self.index: Optional[Dict[str, IndexEntry]] = None
+        self._netloc = parsed.netloc
+        self._base_path = parsed.path.rstrip('/')
+        self._connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def cost(self) -> float:
+        # Estimated seconds to download a typical package from this mirror
+        cost = self.latency if self.latency is not None else self.timeout
+        if self.throughput:
+            cost += TYPICAL_DOWNLOAD_SIZE / self.throughput
+        return cost
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= MAX_FAILURES:
+            self.broken = True
+
+    def _record_latency(self, latency):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    def _record_throughput(self, size, duration):
+        if size < MIN_METERED_SIZE or duration <= 0:
+            return
+        throughput = size / duration
+        self.throughput = throughput if self.throughput is None else 0.8 * self.throughput + 0.2 * throughput
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connection_class(self._netloc, timeout=self.timeout), False
+
+    def _release(self, connection, response):
+        # Only connections whose response was fully read can be reused
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.append(connection)
+        else:
+            connection.close()
+
+    def _request(self, method, path, headers):
+        while True:
+            connection, reused = self._acquire()
+            try:
+                connection.request(method, f'{self._base_path}/{path}', headers=headers)
+                return connection, connection.getresponse()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                # The server may have closed an idle keep-alive connection, retry on a fresh one
+                if not reused:
+                    raise
+
+    def probe(self):
+        # Measures latency while fetching the availability index, if the mirror publishes one
+        start = time.monotonic()
+        try:
+            connection, response = self._request('GET', INDEX_NAME, {})
+            latency = time.monotonic() - start
+            data = response.read()
+            self._release(connection, response)
+            if response.status == 200:
+                self.index = parse_index(data)
+        except (OSError, http.client.HTTPException, ValueError, zstandard.ZstdError):
+            # Unreachable mirrors would cost a full timeout on every package
+            self.broken = True
+            return
+        self._record_latency(latency)
+
+    def has(self, package: str) -> Optional[bool]:
+        # None if the mirror doesn't publish an index
+        if self.index is None:
+            return None
+        return package in self.index
+
+    def entry(self, package: str) -> Optional[IndexEntry]:
+        return self.index.get(package) if self.index is not None else None
+
+    @contextlib.contextmanager
+    def get(self, path: str, headers: Optional[Dict[str, str]] = None):
+        headers = headers or {}
+        start = time.monotonic()
+        try:
+            connection, response = self._request('GET', path, headers)
+        except (OSError, http.client.HTTPException):
+            self.record_failure()
+            raise
+        self._record_latency(time.monotonic() - start)
+
+        if response.status in REDIRECT_STATUSES:
+            location = urllib.parse.urljoin(f'{self.url}/{path}', response.getheader('Location'))
+            response.read()
+            self._release(connection, response)
+            connection = None
+            response = urllib.request.urlopen(urllib.request.Request(location, headers=headers), timeout=self.timeout)
+
+        try:
+            if response.status in MISSING_STATUSES:
+                response.read()
+                raise BincacheError(f'{self.url}/{path}: Not found', response.status)
+            if response.status not in (200, 206):
+                self.record_failure()
+                raise BincacheError(f'{self.url}/{path}: HTTP {response.status}', response.status)
+
+            metered = _MeteredResponse(response)
+            start = time.monotonic()
+            try:
+                yield metered
+            except (OSError, http.client.HTTPException):
+                self.record_failure()
+                raise
+            self.failures = 0
+            self._record_throughput(metered.bytes_read, time.monotonic() - start)
+        finally:
+            if connection is not None:
+                self._release(connection, response)
+            else:
+                response.close()
+
+    @contextlib.contextmanager
+    def download(self, path: str, partial: Path, expected: Optional[IndexEntry] = None):
+        # Yields a stream of the file at `path`, resuming an interrupted transfer into `partial` with a Range request.
+        # A sidecar next to `partial` records what the partial file is expected to become.
+        url = f'{self.url}/{path}'
+        sidecar_path = _sidecar_path(partial)
+        try:
+            sidecar = json.loads(sidecar_path.read_text())
+            offset = partial.stat().st_size
+        except (OSError, ValueError):
+            sidecar = None
+            offset = 0
+        if sidecar is None or sidecar['url'] != url or (sidecar['size'] is not None and offset > sidecar['size']) \
+                or (expected is not None and sidecar['sha256'] not in (None, expected.sha256)):
+            offset = 0
+
+        with contextlib.ExitStack() as stack:
+            if offset and offset == sidecar['size']:
+                # Already fully downloaded, only needs verification
+                response = None
+            else:
+                headers = {}
+                if offset:
+                    headers['Range'] = f'bytes={offset}-'
+                    if sidecar['validator']:
+                        headers['If-Range'] = sidecar['validator']
+                response = stack.enter_context(self.get(path, headers))
+
+                if response.status != 206:
+                    # Fresh download, or the server can't (or won't, because the file changed) resume
+                    offset = 0
+                    content_length = response.getheader('Content-Length')
+                    sidecar = {
+                        'url': url,
+                        'size': int(content_length) if content_length is not None else getattr(expected, 'size', None),
+                        'sha256': getattr(expected, 'sha256', None),
+                        'validator': response.getheader('ETag') or response.getheader('Last-Modified'),
+                    }
+                    sidecar_path.write_text(json.dumps(sidecar, sort_keys=True))
+
+            previous = stack.enter_context(partial.open('rb')) if offset else None
+            partial_file = stack.enter_context(partial.open('ab' if offset else 'wb'))
+            try:
+                yield _ResumedStream(previous, response, partial_file, sidecar)
+            except VerificationError:
+                discard_partial(partial)
+                raise
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+            self._idle.clear()
+
+
+class BinaryCache:
+    # Keeps keep-alive connections to every mirror, and tries the fastest healthy ones first
+    def __init__(self, urls: List[str], timeout: float = 10):
+        self.mirrors = [Mirror(url, timeout) for url in urls]
+        self._probed = False
+        self._lock = threading.Lock()
+
+    def probe(self):
+        if self.mirrors:
+            with ThreadPoolExecutor(max_workers=len(self.mirrors)) as executor:
+                list(executor.map(Mirror.probe, self.mirrors))
+        self._probed = True
+
+    def ranked(self, package: Optional[str] = None) -> List[Mirror]:
+        # If `package` is given, skip mirrors whose index says they don't have it
+        with self._lock:
+            if not self._probed:
+                self.probe()
+        return sorted(
+            (mirror for mirror in self.mirrors if not mirror.broken and (package is None or mirror.has(package) is not False)),
+            key=Mirror.cost,
+        )
+
+    def lookup(self, package: str) -> Optional[IndexEntry]:
+        for mirror in self.ranked(package):
+            if mirror.index is not None:
+                return mirror.index[package]
+        return None
+
+    def fetch(self, path: str, package: Optional[str] = None) -> Optional[bytes]:
+        # Small files (that aren't worth resuming) from the first mirror that has them
+        for mirror in self.ranked(package):
+            try:
+                with mirror.get(path) as response:
+                    return response.read()
+            except (OSError, http.client.HTTPException):
+                continue
+        return None
+
+    def plan(self, packages: List[str]) -> Dict[str, Optional[bool]]:
+        # Whether each package is available from some mirror, None if some mirror can't tell without trying
+        plan = {}
+        for package in packages:
+            availability = [mirror.has(package) for mirror in self.ranked()]
+            plan[package] = True if True in availability else (None if None in availability else False)
+        return plan
+
+    def close(self):
+        for mirror in self.mirrors:
+            mirror.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,195 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from utils import hash_file
+
+# Bump when the way keys are computed changes
+KEY_VERSION = 1
+
+
+def tree_digest(path: Path) -> str:
+    # Digest of a file, or of a directory's names, modes, symlink targets and file contents
+    digest = hashlib.sha256()
+
+    def add(path: Path, name: str):
+        st = path.lstat()
+        digest.update(f'{name}\0{stat.S_IMODE(st.st_mode):o}\0'.encode())
+        if stat.S_ISLNK(st.st_mode):
+            digest.update(b'l' + os.readlink(path).encode() + b'\0')
+        elif stat.S_ISDIR(st.st_mode):
+            digest.update(b'd')
+            for child in sorted(os.listdir(path)):
+                add(path / child, f'{name}/{child}')
+        else:
+            digest.update(b'f')
+            hash_file(path, digest)
+            digest.update(b'\0')
+
+    add(path, '.')
+    return digest.hexdigest()
+
+
+# Holds the key of the last phase completed in the workspace itself
+WORKSPACE_MARKER = '.bold-phase'
+
+
+def _clear_workspace(workspace: Path, keep: str):
+    for child in workspace.iterdir():
+        if child.name == keep:
+            continue
+        if child.is_dir() and not child.is_symlink():
+            shutil.rmtree(child)
+        else:
+            child.unlink()
+
+
+class PhaseCache:
+    # Lets a retried build only rerun the phases whose inputs changed. Each phase is keyed by the key of the phase
+    # before it and its own commands, the first by the workspace path (builds may record absolute paths), the
+    # dependencies and the digests of the fetched externals.
+    # A workspace records the key of the last phase it completed (`WORKSPACE_MARKER`), so one kept after a failure is
+    # resumed in place. Where the workspace can be reflinked into the cache, it's also snapshotted after its latest
+    # phase (a full copy per phase costs about as much as rerunning most phases), which survives the workspace.
+    # Layout: `<cache dir>/<packages>/keys.json` holds the keys of completed phases and which one was snapshotted,
+    # `<key of that phase>/` holds the workspace after it.
+    def __init__(self, root: Path, packages: List[str], workspace: Path, ignore: str = 'activate.sh'):
+        self.dir = root / 'cache' / 'bold' / 'phases' / '+'.join(packages)
+        self.workspace = workspace
+        self.ignore = ignore
+        self.keys: Dict[str, str] = {}
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Held while the cache is written, other bold processes may build the same packages
+        self.dir.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.dir.with_name(f'.{self.dir.name}.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def compute_keys(self, phases: List[str], recipes: Dict[str, dict], metadatas: Dict[str, dict],
+                     external_digests: Dict[str, str]):
+        key = hashlib.sha256(json.dumps({
+            'version': KEY_VERSION,
+            'workspace': str(self.workspace),
+            'depends': {package: metadata['depends'] for package, metadata in metadatas.items()},
+            'buildDepends': {package: recipe['buildDepends'] for package, recipe in recipes.items()},
+            'externals': external_digests,
+        }, sort_keys=True).encode()).hexdigest()
+
+        self.keys = {}
+        for phase in phases:
+            cmds = [recipe['phases'][phase]['cmd'] for recipe in recipes.values()]
+            key = hashlib.sha256(json.dumps([key, phase, cmds]).encode()).hexdigest()
+            self.keys[phase] = key
+
+    def _stored(self) -> Dict:
+        try:
+            return json.loads((self.dir / 'keys.json').read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _can_snapshot(self) -> bool:
+        from externals import reflink_supported
+
+        return os.stat(self.workspace).st_dev == os.stat(self.dir).st_dev and reflink_supported(self.dir)
+
+    def _workspace_phase(self, phases: List[str]) -> Optional[str]:
+        # Keys chain, so a match means every phase up to that one ran with the current inputs
+        try:
+            key = (self.workspace / WORKSPACE_MARKER).read_text()
+        except OSError:
+            return None
+        for phase in phases:
+            if self.keys[phase] == key:
+                return phase
+        return None
+
+    def _snapshot_phase(self, phases: List[str]) -> Optional[str]:
+        stored = self._stored()
+        restorable: Optional[str] = stored.get('snapshot')
+        if restorable not in phases:
+            return None
+        for phase in phases[:phases.index(restorable) + 1]:
+            if stored['keys'].get(phase) != self.keys[phase]:
+                return None
+        if not (self.dir / self.keys[restorable]).is_dir():
+            return None
+        return restorable
+
+    def restore(self, phases: List[str]) -> List[str]:
+        # Brings the workspace to the latest phase completed with unchanged inputs, returns the phases left to run.
+        # A phase that failed is rerun on top of what it left in the workspace. When no phase can be reused, the
+        # workspace is cleared.
+        from externals import clone_file
+
+        in_place = self._workspace_phase(phases)
+        snapshot = self._snapshot_phase(phases)
+        if in_place is not None and (snapshot is None or phases.index(in_place) >= phases.index(snapshot)):
+            return phases[phases.index(in_place) + 1:]
+
+        _clear_workspace(self.workspace, self.ignore)
+        if snapshot is None:
+            return phases
+        shutil.copytree(
+            self.dir / self.keys[snapshot], self.workspace, symlinks=True, dirs_exist_ok=True,
+            copy_function=clone_file,
+        )
+        return phases[phases.index(snapshot) + 1:]
+
+    def save(self, phase: str, snapshot=True):
+        # Records that `phase` completed. Phases that didn't change anything in the workspace needn't be snapshotted.
+        # Cached results of later phases were built on a different workspace, so they are dropped.
+        from externals import clone_file
+
+        marker = self.workspace / WORKSPACE_MARKER
+        marker.with_name(f'{WORKSPACE_MARKER}.tmp').write_text(self.keys[phase])
+        marker.with_name(f'{WORKSPACE_MARKER}.tmp').rename(marker)
+
+        with self._locked():
+            self.dir.mkdir(parents=True, exist_ok=True)
+            stored = self._stored()
+            phase_names = list(self.keys)
+            keys = {
+                name: key for name, key in stored.get('keys', {}).items()
+                if name in phase_names[:phase_names.index(phase)]
+            }
+            keys[phase] = self.keys[phase]
+            snapshot_phase = stored.get('snapshot') if stored.get('snapshot') in keys else None
+
+            # Snapshots are named by their key, so `keys.json` never points at a tree of some other phase
+            if snapshot and self._can_snapshot():
+                staging = Path(tempfile.mkdtemp(prefix=f'.{phase}.', dir=self.dir))
+                try:
+                    shutil.copytree(
+                        self.workspace, staging, symlinks=True, dirs_exist_ok=True, copy_function=clone_file,
+                        ignore=lambda path, names: [self.ignore] if Path(path) == self.workspace else [],
+                    )
+                    shutil.rmtree(self.dir / self.keys[phase], ignore_errors=True)
+                    os.rename(staging, self.dir / self.keys[phase])
+                finally:
+                    shutil.rmtree(staging, ignore_errors=True)
+                snapshot_phase = phase
+
+            tmp_keys = self.dir / '.keys.json.tmp'
+            tmp_keys.write_text(json.dumps({'keys': keys, 'snapshot': snapshot_phase}, sort_keys=True))
+            tmp_keys.rename(self.dir / 'keys.json')
+
+            # Only the latest snapshot is kept
+            for child in self.dir.iterdir():
+                if child.name != 'keys.json' and (snapshot_phase is None or child.name != keys[snapshot_phase]):
+                    if child.is_dir():
+                        shutil.rmtree(child, ignore_errors=True)
+                    else:
+                        child.unlink(missing_ok=True)
+
+    def clear(self):
+        with self._locked():
+            shutil.rmtree(self.dir, ignore_errors=True)
@@ -2,14 +2,27 @@ import json
 import os
 import pipes
 import shutil
+import threading
 import urllib.parse
 import sqlite3
 import subprocess as sp
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
+import zstandard
 from yaspin.core import Yaspin
 
+from archives import DEFAULT_PACK_LEVEL, pack_archive
+from manifests import manifest_path, scan_tree, write_manifest
+from buildcache import PhaseCache, tree_digest
+from externals import ExternalStager
+from utils import human_size, package_deps, read_config
+
+BUILD_PHASES = ['fetch', 'unpack', 'patch', 'build', 'check', 'install', 'fixup', 'installCheck', 'pack']
+
 
 def get_recipe(db, package):
     pkg_name, _, pkg_hash = package.partition('@')
@@ -25,6 +38,88 @@ def get_metadata(db, package):
     return json.loads(metadata)
 
 
+class BuildError(Exception):
+    def __init__(self, package, phase, stdout, stderr):
+        super().__init__(f'Failed to "{phase}" package "{package}"')
+        self.package = package
+        self.phase = phase
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def report(self):
+        return '\n'.join([
+            f'Failed to "{self.phase}" package "{self.package}", attached logs:',
+            '==== STDOUT ====',
+            self.stdout.decode(errors='replace'),
+            '==== STDERR ====',
+            self.stderr.decode(errors='replace'),
+        ])
+
+
+class JobServer:
+    # GNU make compatible jobserver, so the build scheduler and the recipes' `make` share one budget of job slots.
+    # Every running build holds one implicit slot, the pipe holds a token for each additional one.
+    def __init__(self, jobs: int):
+        self.jobs = jobs
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b'+' * (jobs - 1))
+        # make expects blocking reads, so the scheduler polls through its own open file description of the pipe
+        self._poll_fd = os.open(f'/proc/self/fd/{self.read_fd}', os.O_RDONLY | os.O_NONBLOCK)
+
+    def try_acquire(self) -> bool:
+        try:
+            return len(os.read(self._poll_fd, 1)) == 1
+        except BlockingIOError:
+            return False
+
+    def release(self):
+        os.write(self.write_fd, b'+')
+
+    @property
+    def fds(self):
+        return self.read_fd, self.write_fd
+
+    def env(self) -> Dict[str, str]:
+        return {
+            **os.environ,
+            'MAKEFLAGS': f'-j{self.jobs} --jobserver-auth={self.read_fd},{self.write_fd}',
+            'BOLD_JOBS': str(self.jobs),
+        }
+
+    def close(self):
+        for fd in (self._poll_fd, self.read_fd, self.write_fd):
+            os.close(fd)
+
+
+def dependency_order(db, packages: List[str]):
+    # Runtime and build dependencies inside the given set
+    deps: Dict[str, Set[str]] = {}
+    dependents: Dict[str, Set[str]] = {package: set() for package in packages}
+    for package, direct in package_deps(db, packages).items():
+        deps[package] = {dep for dep in direct if dep in dependents and dep != package}
+        for dep in deps[package]:
+            dependents[dep].add(package)
+
+    # Rank each package by the longest chain of dependents above it, so the critical path of the graph goes first.
+    # A dependency always ranks strictly higher than its dependents.
+    rank = {}
+    remaining = {package: len(dependents[package]) for package in packages}
+    ready = [package for package in packages if remaining[package] == 0]
+    while ready:
+        package = ready.pop()
+        rank[package] = max((rank[dependent] + 1 for dependent in dependents[package]), default=0)
+        for dep in deps[package]:
+            remaining[dep] -= 1
+            if remaining[dep] == 0:
+                ready.append(dep)
+
+    # Dependency cycles shouldn't happen, but don't lose packages if they do
+    for package in packages:
+        rank.setdefault(package, 0)
+
+    return deps, sorted(packages, key=lambda package: rank[package], reverse=True)
+
+
 class ExternalResource:
     def __init__(self, package, name, uri):
         self.package = package
@@ -48,28 +143,84 @@ def _quote(s):
     return pipes.quote(str(s))
 
 
-def fetch_externals(externals: List[ExternalResource], root: Path, workspace: Path, spinner: Yaspin, spinner_prefix=''):
+def _local_path(external: ExternalResource, root: Path) -> Optional[Path]:
+    if external.type == 'Local from src directory':
+        return root / 'src' / external.uri_parsed.netloc
+    elif external.type == 'Local from repo':
+        return root / 'src' / 'repo' / external.uri_parsed.path.lstrip('/')
+    return None
+
+
+def fetch_externals(externals: List[ExternalResource], root: Path, workspace: Path, spinner: Yaspin,
+                    spinner_prefix='') -> Dict[str, str]:
+    # Returns the content digest of each staged external
+    stager = ExternalStager(root)
+    digests = {}
     for external in externals:
         spinner.text = f'{spinner_prefix}Fetching: {external.full_name}'
 
-        if external.type == 'Local from src directory':
-            # Copy local file
-            local_path = root / 'src' / external.uri_parsed.netloc
-            if local_path.is_dir():
-                shutil.copytree(local_path, workspace / external.full_name)
-            else:
-                shutil.copy(local_path, workspace / external.full_name)
-        elif external.type == 'Local from repo':
-            # Copy local file
-            local_path = root / 'src' / 'repo' / external.uri_parsed.path.lstrip('/')
-            if local_path.is_dir():
-                shutil.copytree(local_path, workspace / external.full_name)
-            else:
-                shutil.copy(local_path, workspace / external.full_name)
+        local_path = _local_path(external, root)
+        if local_path is not None:
+            digests[external.full_name] = stager.stage(local_path, workspace / external.full_name)
+
+    return digests
+
+
+def format_timings(timings: Dict[str, float]) -> str:
+    total = sum(timings.values())
+    return f'{total:.1f}s (' + ', '.join(f'{phase} {duration:.1f}s' for phase, duration in timings.items()) + ')'
+
+
+class PhaseShell:
+    # One long-lived shell per package: `activate.sh` is parsed once, then phases are sent over the shell's stdin.
+    # Each phase runs in a subshell (so a failing `set -e` or a `cd` doesn't leak into the next phase) with its output
+    # redirected to log files, and its exit status is reported on the shell's stdout.
+    def __init__(self, package: str, workspace: Path, jobserver: JobServer):
+        self.package_esc = package.replace('@', '_')
+        self.logs = tempfile.TemporaryDirectory(prefix='bold-build-')
+        self.process = sp.Popen(
+            ['sh', '-s'], stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.DEVNULL, cwd=workspace,
+            pass_fds=jobserver.fds, env=jobserver.env(),
+        )
+        self._send(f'. {_quote(workspace / "activate.sh")} || exit 1')
+
+    def _send(self, command: str):
+        try:
+            self.process.stdin.write(f'{command}\n'.encode())
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            # The shell died, `run` reports it when its stdout reaches EOF
+            pass
+
+    def run(self, phase: str) -> Tuple[int, bytes, bytes, float]:
+        # Returns the exit status, stdout, stderr and duration of the phase
+        stdout_path = Path(self.logs.name) / f'{phase}.out'
+        stderr_path = Path(self.logs.name) / f'{phase}.err'
+        start = time.monotonic()
+        self._send(
+            f'(set -e; bold_{phase}_{self.package_esc}) >{_quote(stdout_path)} 2>{_quote(stderr_path)} </dev/null; '
+            f'echo $?'
+        )
+        status = self.process.stdout.readline()
+        duration = time.monotonic() - start
+        returncode = int(status) if status else (self.process.wait() or -1)
+
+        def read(path):
+            return path.read_bytes() if path.exists() else b''
+        return returncode, read(stdout_path), read(stderr_path), duration
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+        self.logs.cleanup()
 
 
 def build_packages(packages: List[str], root: Path, workspace: Path,
-                   phases: List[str], spinner: Yaspin, db, spinner_prefix=''):
+                   phases: List[str], spinner: Yaspin, db, spinner_prefix='', jobserver: Optional[JobServer] = None):
     spinner.text = f'{spinner_prefix}Getting recipes'
 
     # Get all recipes
@@ -83,71 +234,71 @@ def build_packages(packages: List[str], root: Path, workspace: Path,
             external = ExternalResource(package, external_name, recipe['externals'][external_name])
             externals.append(external)
 
-    # Create build environment if needed
+    # Create build environment, a workspace kept from a failed build gets the current recipes' script
     if workspace.exists():
         assert workspace.is_dir()
     else:
         workspace.mkdir(parents=True)
 
-        spinner.text = f'{spinner_prefix}Creating environment'
-        with open(os.open(workspace / 'activate.sh', os.O_CREAT | os.O_WRONLY, 0o755), 'w') as fd:
-            main_pkg = packages[0].replace('@', '_')
-            script = '#!/bin/echo "This script should be sourced in a shell, not executed directly"\n'
-
-            unset = ['BOLD_WORKSPACE']
-            script += f'export BOLD_WORKSPACE={_quote(workspace)}\n\n'
-
-            for phase in ['unpack', 'patch', 'build', 'check', 'install', 'fixup', 'installCheck']:
-                for package in packages:
-                    package_esc = package.replace('@', '_')
-                    unset.append(f'bold_{phase}_{package_esc}')
-                    script += f'bold_{phase}_{package_esc}() {{\n'
-                    script += f'  _oldpath=`pwd`; cd {workspace}\n'
-                    script += f'  export DESTDIR={_quote(workspace / "dest" / package)}\n'
-                    script += f'  mkdir -p "$DESTDIR"\n'
-                    for dep_name, dep_id in metadatas[package]['depends'].items():
-                        script += f'  export DEP_{dep_name}={_quote(root / "app" / dep_id)}\n'
-                    for dep_name, dep_id in recipes[package]['buildDepends'].items():
-                        script += f'  export BDEP_{dep_name}={_quote(root / "app" / dep_id)}\n'
-                    for external in externals:
-                        if external.package == package:
-                            script += f'  export EXT_{external.name}={_quote(workspace / external.full_name)}\n'
-
-                    script += f'  {recipes[package]["phases"][phase]["cmd"]}\n'
-
-                    for external in externals:
-                        if external.package == package:
-                            script += f'  unset EXT_{external.name}\n'
-                    for dep_name, _ in recipes[package]['buildDepends'].items():
-                        script += f'  unset BDEP_{dep_name}\n'
-                    for dep_name, _ in metadatas[package]['depends'].items():
-                        script += f'  unset DEP_{dep_name}\n'
-                    script += f'  cd $_oldpath\n'
-                    script += f'}}\n'
-
-                unset.append(f'bold_{phase}')
-                script += f'bold_{phase}() {{\n'
-                script += f'  bold_{phase}_{main_pkg}\n'
+    spinner.text = f'{spinner_prefix}Creating environment'
+    with open(os.open(workspace / 'activate.sh', os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o755), 'w') as fd:
+        main_pkg = packages[0].replace('@', '_')
+        script = '#!/bin/echo "This script should be sourced in a shell, not executed directly"\n'
+
+        unset = ['BOLD_WORKSPACE']
+        script += f'export BOLD_WORKSPACE={_quote(workspace)}\n\n'
+
+        for phase in ['unpack', 'patch', 'build', 'check', 'install', 'fixup', 'installCheck']:
+            for package in packages:
+                package_esc = package.replace('@', '_')
+                unset.append(f'bold_{phase}_{package_esc}')
+                script += f'bold_{phase}_{package_esc}() {{\n'
+                script += f'  _oldpath=`pwd`; cd {workspace}\n'
+                script += f'  export DESTDIR={_quote(workspace / "dest" / package)}\n'
+                script += f'  mkdir -p "$DESTDIR"\n'
+                for dep_name, dep_id in metadatas[package]['depends'].items():
+                    script += f'  export DEP_{dep_name}={_quote(root / "app" / dep_id)}\n'
+                for dep_name, dep_id in recipes[package]['buildDepends'].items():
+                    script += f'  export BDEP_{dep_name}={_quote(root / "app" / dep_id)}\n'
+                for external in externals:
+                    if external.package == package:
+                        script += f'  export EXT_{external.name}={_quote(workspace / external.full_name)}\n'
+
+                script += f'  {recipes[package]["phases"][phase]["cmd"]}\n'
+
+                for external in externals:
+                    if external.package == package:
+                        script += f'  unset EXT_{external.name}\n'
+                for dep_name, _ in recipes[package]['buildDepends'].items():
+                    script += f'  unset BDEP_{dep_name}\n'
+                for dep_name, _ in metadatas[package]['depends'].items():
+                    script += f'  unset DEP_{dep_name}\n'
+                script += f'  cd $_oldpath\n'
                 script += f'}}\n'
 
-            unset.append('bold_help')
-            script += f'bold_help() {{\n'
-            script += f'echo "** Welcome to the Bold build environment! **"\n'
-            script += f'echo "This environment is ready for developing the following packages: {", ".join(packages)}"\n'
-            script += f'echo \'You may build each package by calling `bold_build_<NAME>`, e.g. `bold_build_{main_pkg}`\'\n'
-            script += f'echo \'All packages/libraries can be built by simply running `bold_build`.\'\n'
-            script += f'echo \'After building an package, you will likely want to `bold_install_<NAME>` it (or just\'\n'
-            script += f'echo \'    `bold_install`) to move it to the expected directory.\'\n'
-            script += f'echo \'More info is available in the manual (TODO)\'\n'
-            script += f'}}\n'
-
-            unset.append('bold_deactivate')
-            script += f'bold_deactivate() {{\n'
-            for unset_var in unset:
-                script += f'  unset {unset_var}\n'
+            unset.append(f'bold_{phase}')
+            script += f'bold_{phase}() {{\n'
+            script += f'  bold_{phase}_{main_pkg}\n'
             script += f'}}\n'
 
-            fd.write(script)
+        unset.append('bold_help')
+        script += f'bold_help() {{\n'
+        script += f'echo "** Welcome to the Bold build environment! **"\n'
+        script += f'echo "This environment is ready for developing the following packages: {", ".join(packages)}"\n'
+        script += f'echo \'You may build each package by calling `bold_build_<NAME>`, e.g. `bold_build_{main_pkg}`\'\n'
+        script += f'echo \'All packages/libraries can be built by simply running `bold_build`.\'\n'
+        script += f'echo \'After building an package, you will likely want to `bold_install_<NAME>` it (or just\'\n'
+        script += f'echo \'    `bold_install`) to move it to the expected directory.\'\n'
+        script += f'echo \'More info is available in the manual (TODO)\'\n'
+        script += f'}}\n'
+
+        unset.append('bold_deactivate')
+        script += f'bold_deactivate() {{\n'
+        for unset_var in unset:
+            script += f'  unset {unset_var}\n'
+        script += f'}}\n'
+
+        fd.write(script)
 
     do_fetch = 'fetch' in phases
     if do_fetch:
@@ -156,43 +307,171 @@ def build_packages(packages: List[str], root: Path, workspace: Path,
     if do_pack:
         phases.remove('pack')
 
-    # Fetch external resources
-    if do_fetch:
-        spinner.stop()
-        print('Fetching the following resources:')
+    # Skip phases whose inputs didn't change since they last completed, in this workspace or a cached snapshot.
+    # The externals to fetch are keyed by their sources, they're only staged if the phases after fetch all rerun.
+    spinner.text = f'{spinner_prefix}Looking up cached phases'
+    phase_cache = PhaseCache(root, packages, workspace)
+    stager = ExternalStager(root)
+    external_digests = {}
+    for external in externals:
+        local_path = _local_path(external, root)
+        if do_fetch and local_path is not None:
+            external_digests[external.full_name] = stager.digest(local_path)
+        elif not do_fetch and os.path.lexists(workspace / external.full_name):
+            external_digests[external.full_name] = tree_digest(workspace / external.full_name)
+    phase_cache.compute_keys(phases, recipes, metadatas, external_digests)
+    remaining_phases = phase_cache.restore(phases)
+    if len(remaining_phases) < len(phases):
+        cached_phases = phases[:len(phases) - len(remaining_phases)]
+        spinner.write(f'Reusing completed phases of {", ".join(packages)}: {", ".join(cached_phases)}')
+    elif do_fetch:
+        # Fetch external resources into the workspace `restore` cleared
+        spinner.write('Fetching the following resources:')
         for external in externals:
-            print(f'- {external.full_name} ({external.type})')
+            spinner.write(f'- {external.full_name} ({external.type})')
 
-        spinner.start()
         fetch_externals(externals, root, workspace, spinner, spinner_prefix)
 
     # Run requested phases
-    for phase in phases:
-        for package in packages:
-            package_esc = package.replace('@', '_')
-            spinner.text = f'{spinner_prefix}Preparing {package} ({phase})'
-            try:
-                sp.check_output(
-                    ['sh', '-c', f'set -e; . {_quote(workspace / "activate.sh")} && bold_{phase}_{package_esc}'],
-                    stderr=sp.PIPE
-                )
-            except sp.CalledProcessError as e:
-                spinner.stop()
-                print(f'Failed to "{phase}" package "{package}", attached logs:')
-                print('==== STDOUT ====')
-                print(e.stdout.decode())
-                print('==== STDERR ====')
-                print(e.stderr.decode())
-                exit(1)
-
-    # Pack result
-    if do_pack:
-        spinner.text = f'{spinner_prefix}Packing result'
-        for package in packages:
-            sp.call([
-                'tar', '-Izstd -10',
-                # unix time 946684800 == 2000-01-01 00:00:00
-                '--sort=name', '--mtime=@946684800', '--owner=0', '--group=0', '--numeric-owner',
-                '-cf', root / 'cache' / 'bold' / 'bincache' / f'{package}.tar.zst',
-                '-C', workspace / 'dest' / package, '.'
-            ])
+    own_jobserver = jobserver is None
+    if own_jobserver:
+        jobserver = JobServer(os.cpu_count())
+    timings: Dict[str, Dict[str, float]] = {package: {} for package in packages}
+    shells: Dict[str, PhaseShell] = {}
+    try:
+        try:
+            for phase in remaining_phases:
+                for package in packages:
+                    spinner.text = f'{spinner_prefix}Preparing {package} ({phase})'
+                    if package not in shells:
+                        shells[package] = PhaseShell(package, workspace, jobserver)
+                    returncode, stdout, stderr, duration = shells[package].run(phase)
+                    timings[package][phase] = duration
+                    if returncode != 0:
+                        raise BuildError(package, phase, stdout, stderr)
+                phase_cache.save(phase, snapshot=any(recipes[package]['phases'][phase]['cmd'].strip() for package in packages))
+        finally:
+            for shell in shells.values():
+                shell.close()
+
+        # Pack result
+        if do_pack:
+            config = read_config(root)
+            bincache_dir = root / 'cache' / 'bold' / 'bincache'
+            bincache_dir.mkdir(parents=True, exist_ok=True)
+            max_threads = config.get('packThreads', jobserver.jobs)
+
+            def pack(package):
+                # Compresses on this build's job slot, plus as many free jobserver tokens as `packThreads` allows
+                extra_tokens = 0
+                while extra_tokens < max_threads - 1 and jobserver.try_acquire():
+                    extra_tokens += 1
+                start = time.monotonic()
+                try:
+                    sizes = pack_archive(
+                        workspace / 'dest' / package, bincache_dir / f'{package}.tar.zst',
+                        level=config.get('packLevel', DEFAULT_PACK_LEVEL),
+                        threads=extra_tokens + 1 if extra_tokens else 0,
+                        long_distance=config.get('packLongDistance', False),
+                    )
+                    write_manifest(scan_tree(workspace / 'dest' / package), manifest_path(bincache_dir, package))
+                except (OSError, zstandard.ZstdError) as e:
+                    raise BuildError(package, 'pack', b'', str(e).encode())
+                finally:
+                    for _ in range(extra_tokens):
+                        jobserver.release()
+                timings[package]['pack'] = time.monotonic() - start
+                return sizes
+
+            for package in packages:
+                spinner.text = f'{spinner_prefix}Packing {package}'
+                uncompressed, compressed = pack(package)
+                spinner.write(f'Packed {package}: {human_size(uncompressed)} -> {human_size(compressed)}')
+    finally:
+        if own_jobserver:
+            jobserver.close()
+
+    return timings
+
+
+def build_package_graph(packages: List[str], root: Path, db_path: Path, jobs: int, board,
+                        after_build: Optional[Callable[[str, object], None]] = None) -> bool:
+    # Builds independent packages in parallel, each package only after its dependencies in the set were built
+    # (and handed to `after_build`, e.g. to install them). Stops scheduling on the first failure.
+    deps, order = dependency_order(sqlite3.connect(db_path), packages)
+    rank = {package: i for i, package in enumerate(order)}
+    pending = set(packages)
+    done = set()
+    failed = {}
+    running = {}
+    implicit_slot_free = True
+    jobserver = JobServer(jobs)
+    local = threading.local()
+
+    def build(package):
+        # sqlite connections can't be shared between threads
+        if not hasattr(local, 'db'):
+            local.db = sqlite3.connect(db_path)
+        status = board.worker()
+        workspace = root / 'cache' / 'bold' / 'build' / package
+        # Kept after a failure, the phases it completed are skipped unless their inputs changed since
+        timings = build_packages(
+            [package], root, workspace, list(BUILD_PHASES), status, local.db, 'Building package: ', jobserver,
+        )
+        if timings[package]:
+            status.write(f'Built {package}: {format_timings(timings[package])}')
+        if after_build:
+            after_build(package, status)
+        # The result is in the bincache now
+        PhaseCache(root, [package], workspace).clear()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while running or (pending and not failed):
+                if not failed:
+                    for package in sorted((p for p in pending if deps[p] <= done), key=rank.get):
+                        if implicit_slot_free:
+                            implicit_slot_free = False
+                            holds_token = False
+                        elif jobserver.try_acquire():
+                            holds_token = True
+                        else:
+                            break
+                        pending.remove(package)
+                        running[executor.submit(build, package)] = (package, holds_token)
+
+                    if not running:
+                        # Only dependency cycles are left
+                        break
+
+                # Tokens may also be returned by `make` processes, so poll
+                finished, _ = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    package, holds_token = running.pop(future)
+                    if holds_token:
+                        jobserver.release()
+                    else:
+                        implicit_slot_free = True
+
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed[package] = e
+                    else:
+                        done.add(package)
+                    board.advance()
+    finally:
+        jobserver.close()
+
+    for package, error in failed.items():
+        workspace = root / 'cache' / 'bold' / 'build' / package
+        if isinstance(error, BuildError):
+            (workspace / 'build.log').write_text(error.report())
+            board.write(f'Failed to "{error.phase}" package "{package}", logs kept in {workspace / "build.log"}')
+        else:
+            board.write(f'Failed to build package "{package}": {error}')
+    if pending:
+        board.write(f'Not built: {", ".join(sorted(pending))}')
+
+    return not failed and not pending
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+
+class SnapshotCatalog:
+    # Index of all snapshots in `/bold/snapshot/catalog.db3`, so looking snapshots up doesn't mean
+    # listing the snapshot directory and parsing every `metadata.json`
+    def __init__(self, root: Path):
+        self.snapshot_dir = root / 'snapshot'
+        path = self.snapshot_dir / 'catalog.db3'
+        is_new = not path.exists()
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        with self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS "snapshots"
+                (
+                    "id"                INTEGER NOT NULL PRIMARY KEY,
+                    "parent"            INTEGER REFERENCES "snapshots" ("id") ON DELETE SET NULL,
+                    "created"           TEXT    NOT NULL,
+                    "description"       TEXT    NOT NULL,
+                    "alias"             TEXT,
+                    "repo_hash"         TEXT    NOT NULL,
+                    "state"             TEXT    NOT NULL DEFAULT 'ready'
+                );
+            ''')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS "snapshot_packages"
+                (
+                    "snapshot"          INTEGER NOT NULL REFERENCES "snapshots" ("id") ON DELETE CASCADE,
+                    "package"           TEXT    NOT NULL,
+                    "global"            INTEGER NOT NULL,
+                    PRIMARY KEY ("snapshot", "package")
+                ) WITHOUT ROWID;
+            ''')
+            # `ready` snapshots have their root, `compressed` ones only metadata (their packages are in the bincache),
+            # and `archived` ones are folded into `<id>.archive.tar`
+            if 'state' not in [row[1] for row in self.db.execute('PRAGMA table_info("snapshots")')]:
+                self.db.execute('ALTER TABLE "snapshots" ADD COLUMN "state" TEXT NOT NULL DEFAULT \'ready\'')
+            self.db.execute('CREATE INDEX IF NOT EXISTS "snapshots_parent" ON "snapshots" ("parent")')
+            self.db.execute('CREATE INDEX IF NOT EXISTS "snapshots_created" ON "snapshots" ("created")')
+            self.db.execute('CREATE INDEX IF NOT EXISTS "snapshot_packages_package" ON "snapshot_packages" ("package", "snapshot")')
+
+        if is_new:
+            self._import_existing()
+
+    def _import_existing(self):
+        # One time migration of snapshots created before the catalog existed
+        snapshot_ids = sorted(int(snap.name) for snap in self.snapshot_dir.iterdir() if snap.name.isdigit())
+        with self.db:
+            for snapshot_id in snapshot_ids:
+                self._import(snapshot_id)
+
+    def _import(self, snapshot_id: int):
+        snapshot = self.snapshot_dir / str(snapshot_id)
+        with (snapshot / 'metadata.json').open() as f:
+            metadata = json.load(f)
+        parent = int(os.readlink(snapshot / 'parent').rpartition('/')[2]) if (snapshot / 'parent').is_symlink() else None
+        self._insert(snapshot_id, parent, metadata)
+
+    def _insert(self, snapshot_id: int, parent: Optional[int], metadata: Dict):
+        if parent is not None and not self.exists(parent):
+            parent = None
+        self.db.execute(
+            'INSERT INTO snapshots (id, parent, created, description, alias, repo_hash) VALUES (?, ?, ?, ?, ?, ?)',
+            (snapshot_id, parent, metadata['created'], metadata['description'], metadata['alias'], metadata['repoHash']),
+        )
+        self.db.executemany(
+            'INSERT INTO snapshot_packages (snapshot, package, global) VALUES (?, ?, ?)',
+            ((snapshot_id, package, info['global']) for package, info in metadata['packages'].items()),
+        )
+
+    def add(self, next_dir: Path, parent: Optional[int], metadata: Dict) -> int:
+        # Catalogs the snapshot prepared in `next_dir` and renames it to its id, in one transaction:
+        # if the rename fails the snapshot isn't cataloged
+        with self.db:
+            # Lock the catalog before picking an id, other bold processes may be creating snapshots too
+            self.db.execute('BEGIN IMMEDIATE')
+            snapshot_id = self.db.execute('SELECT coalesce(max(id), 0) + 1 FROM snapshots').fetchone()[0]
+            # A snapshot renamed into place whose transaction didn't commit (e.g. power loss), catalog it
+            while (self.snapshot_dir / str(snapshot_id)).exists():
+                self._import(snapshot_id)
+                snapshot_id += 1
+
+            self._insert(snapshot_id, parent, metadata)
+            next_dir.rename(self.snapshot_dir / str(snapshot_id))
+        return snapshot_id
+
+    def exists(self, snapshot_id: int) -> bool:
+        return self.db.execute('SELECT 1 FROM snapshots WHERE id = ?', (snapshot_id,)).fetchone() is not None
+
+    def get(self, snapshot_id: int) -> Optional[Dict]:
+        row = self.db.execute(
+            'SELECT id, parent, created, description, alias, repo_hash, state FROM snapshots WHERE id = ?', (snapshot_id,),
+        ).fetchone()
+        return self._row_to_dict(row) if row is not None else None
+
+    def list(self) -> List[Dict]:
+        return [
+            self._row_to_dict(row)
+            for row in self.db.execute(
+                'SELECT id, parent, created, description, alias, repo_hash, state FROM snapshots ORDER BY id'
+            )
+        ]
+
+    @staticmethod
+    def _row_to_dict(row) -> Dict:
+        snapshot_id, parent, created, description, alias, repo_hash, state = row
+        return {
+            'id': snapshot_id, 'parent': parent, 'created': created,
+            'description': description, 'alias': alias, 'repoHash': repo_hash, 'state': state,
+        }
+
+    def packages(self, snapshot_id: int) -> Dict[str, bool]:
+        return {
+            package: bool(is_global)
+            for package, is_global in self.db.execute(
+                'SELECT package, global FROM snapshot_packages WHERE snapshot = ?', (snapshot_id,),
+            )
+        }
+
+    def ancestors(self, snapshot_id: int) -> List[int]:
+        # The snapshot itself first, then its parent, and so on
+        return [row[0] for row in self.db.execute('''
+            WITH RECURSIVE ancestry(id, depth) AS (
+                SELECT id, 0 FROM snapshots WHERE id = ?
+                UNION ALL
+                SELECT S.parent, A.depth + 1 FROM snapshots S JOIN ancestry A ON S.id = A.id WHERE S.parent IS NOT NULL
+            )
+            SELECT id FROM ancestry ORDER BY depth
+        ''', (snapshot_id,))]
+
+    def older_than(self, created: str) -> List[int]:
+        # `created` is an ISO timestamp, like the ones in snapshot metadata
+        return [row[0] for row in self.db.execute('SELECT id FROM snapshots WHERE created < ? ORDER BY id', (created,))]
+
+    def referencing(self, package: str) -> List[int]:
+        return [
+            row[0]
+            for row in self.db.execute('SELECT snapshot FROM snapshot_packages WHERE package = ? ORDER BY snapshot', (package,))
+        ]
+
+    def referenced_packages(self, excluding: Iterable[int] = (), states: Iterable[str] = ('ready',)) -> Set[str]:
+        # Packages used by any snapshot in one of `states`, except the ones in `excluding`
+        excluding = list(excluding)
+        states = list(states)
+        return {row[0] for row in self.db.execute(f'''
+            SELECT DISTINCT P.package
+            FROM snapshot_packages P JOIN snapshots S ON S.id = P.snapshot
+            WHERE P.snapshot NOT IN ({', '.join('?' * len(excluding))}) AND S.state IN ({', '.join('?' * len(states))})
+        ''', excluding + states)}
+
+    def set_state(self, snapshot_id: int, state: str):
+        with self.db:
+            self.db.execute('UPDATE snapshots SET state = ? WHERE id = ?', (state, snapshot_id))
+
+    def remove(self, snapshot_id: int):
+        with self.db:
+            self.db.execute('DELETE FROM snapshots WHERE id = ?', (snapshot_id,))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,137 @@
+import datetime
+import os
+from pathlib import Path
+
+from yaspin import yaspin
+
+from bincache import INDEX_NAME, write_index
+from catalog import SnapshotCatalog
+from coldstorage import archive_snapshot, compress_snapshot, count_inodes
+from garbage import parse_age, pinned_snapshots, plan_gc, sweep
+from store import ContentStore, app_usage
+from utils import human_size
+
+
+def cmd_gc_dedup(args):
+    root = Path(args.root)
+    store = ContentStore(root)
+
+    with yaspin(text='Deduplicating /bold/app into the content store'):
+        freed = store.dedup_tree(root / 'app', args.jobs or os.cpu_count())
+        apparent, actual = app_usage(root)
+
+    print(f'Linked {store.linked_files} files into the content store, freed {human_size(freed)}')
+    print(f'Installed packages use {human_size(actual)} on disk for {human_size(apparent)} of files '
+          f'({human_size(apparent - actual)} saved)')
+
+
+def _select_snapshots(args, catalog: SnapshotCatalog, pinned, action='removing'):
+    # Explicitly requested snapshots must exist and not be in use, the ones selected by age skip those in use
+    selected = set()
+    for generation in args.generation:
+        if not generation.isdigit() or not catalog.exists(int(generation)):
+            print(f'No such snapshot: {generation}')
+            exit(1)
+        if int(generation) in pinned:
+            print(f'Snapshot {generation} is in use, not {action} it')
+            exit(1)
+        selected.add(int(generation))
+
+    if args.older_than:
+        try:
+            age = parse_age(args.older_than)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        cutoff = (datetime.datetime.now() - age).isoformat()
+        selected |= set(catalog.older_than(cutoff)) - pinned
+
+    return sorted(selected)
+
+
+def cmd_gc_remove(args):
+    root = Path(args.root)
+
+    if not (root / 'snapshot' / 'current').exists():
+        print('Nothing to collect, run `bold update` first')
+        return
+
+    with SnapshotCatalog(root) as catalog:
+        snapshots = _select_snapshots(args, catalog, pinned_snapshots(root))
+
+        with yaspin(text='Looking for unreferenced packages'):
+            plan = plan_gc(root, catalog, snapshots, args.keep_archives)
+
+        verb = 'Would remove' if args.dry_run else 'Removing'
+        if plan.snapshots:
+            print(f'{verb} {len(plan.snapshots)} snapshots: {", ".join(map(str, plan.snapshots))}')
+        if plan.app_dirs:
+            print(f'{verb} {len(plan.app_dirs)} unreferenced packages from {root / "app"}')
+        archives = [archive for archive in plan.archives if archive.name.endswith('.tar.zst')]
+        if archives:
+            print(f'{verb} {len(archives)} unreferenced archives from the binary cache')
+        if plan.store_entries:
+            print(f'{verb} {len(plan.store_entries)} unused files from the content store')
+        trees = [path for path in plan.external_trees if path.parent.name == 'trees']
+        if trees:
+            print(f'{verb} {len(trees)} outdated copies of local sources from the build cache')
+
+        if args.dry_run:
+            print(f'Would free {human_size(plan.freed)}')
+            return
+
+        with yaspin(text='Removing garbage'):
+            sweep(root, catalog, plan, args.jobs or os.cpu_count())
+
+            # Mirrors serving this bincache shouldn't advertise removed archives
+            bincache_dir = root / 'cache' / 'bold' / 'bincache'
+            if archives and (bincache_dir / INDEX_NAME).exists():
+                write_index(bincache_dir)
+
+    print(f'Freed {human_size(plan.freed)}')
+
+
+def _make_cold(args, action: str, state: str, make_cold):
+    root = Path(args.root)
+
+    if not (root / 'snapshot' / 'current').exists():
+        print('No snapshots yet, run `bold update` first')
+        return
+
+    with SnapshotCatalog(root) as catalog:
+        # Compressing an archived snapshot would mean restoring it first
+        skip_states = {'compressed': ('compressed', 'archived'), 'archived': ('archived',)}[state]
+        snapshots = [
+            snapshot_id for snapshot_id in _select_snapshots(args, catalog, pinned_snapshots(root), action)
+            if catalog.get(snapshot_id)['state'] not in skip_states
+        ]
+        if not snapshots:
+            print('No snapshots to move to cold storage')
+            return
+
+        jobs = args.jobs or os.cpu_count()
+        inodes = 0
+        with yaspin() as spinner:
+            for snapshot_id in snapshots:
+                spinner.text = f'{action.capitalize()} snapshot {snapshot_id}'
+                try:
+                    inodes += make_cold(root, catalog, snapshot_id, jobs)
+                except RuntimeError as e:
+                    spinner.write(str(e))
+
+            # Packages only cold snapshots use aren't needed in /bold/app anymore, they can be restored from the bincache
+            spinner.text = 'Removing packages only used by cold snapshots'
+            plan = plan_gc(root, catalog, [], keep_archives=True)
+            inodes += sum(count_inodes(app_dir) + 1 for app_dir in plan.app_dirs) + len(plan.store_entries)
+            sweep(root, catalog, plan, jobs)
+
+    print(f'{state.capitalize()} snapshots {", ".join(map(str, snapshots))}: '
+          f'{inodes} fewer inodes, freed {human_size(plan.freed)} from /bold/app')
+
+
+def cmd_gc_compress(args):
+    _make_cold(args, 'compressing', 'compressed', compress_snapshot)
+
+
+def cmd_gc_archive(args):
+    _make_cold(args, 'archiving', 'archived', archive_snapshot)
@@ -9,7 +9,8 @@ from pathlib import Path
 
 from yaspin.core import Yaspin
 
-from building import build_packages
+from building import BuildError, build_packages, format_timings
+from buildcache import PhaseCache
 from utils import parse_package_names
 
 
@@ -74,11 +75,21 @@ def cmd_hack(args):
     else:
         phases = ['fetch', 'unpack', 'patch']
 
-    build_packages(
-        parsed_packages, root, workspace, phases,
-        spinner, db, 'Creating workspace: '
-    )
+    try:
+        timings = build_packages(
+            parsed_packages, root, workspace, phases,
+            spinner, db, 'Creating workspace: '
+        )
+    except BuildError as e:
+        spinner.stop()
+        print(e.report())
+        exit(1)
+    # Snapshots are only kept for retrying failed builds, the workspace has the result now
+    PhaseCache(root, parsed_packages, workspace).clear()
 
     spinner.stop()
+    for package, package_timings in timings.items():
+        if package_timings:
+            print(f'{package}: {format_timings(package_timings)}')
     print(f'Done! Run `source {workspace_name}/activate.sh` to begin working.')
     print(f'Get help by running `bold_help` after activating.')
@@ -1,18 +1,37 @@
 import datetime
-import shutil
+import http.client
+import os
 import sqlite3
-import urllib.parse
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import subprocess as sp
+from typing import List, Optional
 
+import zstandard
 from yaspin import yaspin
 
-from building import build_packages
-from utils import parse_package_names, read_config, find_package_deps
+from archives import extract_archive
+from bincache import BinaryCache, discard_partial
+from deltas import fetch_delta
+from manifests import ManifestIndex, manifest_path, write_manifest
+from building import build_package_graph, dependency_order
+from progress import ProgressBoard
+from utils import parse_package_names, read_config, find_package_deps, human_size
 from snapshots import prepare_snapshot, commit_snapshot, current_snapshot_metadata
+from store import ContentStore
 
 
-def install_package(package: str, root: Path, db, spinner, spinner_prefix=''):
+def _extract(stream, root: Path, package: str, store: Optional[ContentStore]):
+    # The manifest comes with the extraction, mirrors that don't publish manifests cost no extra pass over the files
+    entries = extract_archive(stream, root, package, store=store)
+    manifest = manifest_path(root / 'cache' / 'bold' / 'bincache', package)
+    if not manifest.exists():
+        write_manifest(entries, manifest)
+
+
+def install_package(package: str, root: Path, spinner, bincache: BinaryCache, spinner_prefix='',
+                    store: Optional[ContentStore] = None):
+    # Returns False if the package isn't available from any binary cache, and has to be built
     spinner.text = f'Installing {package}'
     bincache_archive = root / 'cache' / 'bold' / 'bincache' / f'{package}.tar.zst'
 
@@ -20,53 +39,127 @@ def install_package(package: str, root: Path, db, spinner, spinner_prefix=''):
         return True
 
     if not bincache_archive.exists():
-        # TODO: Download from https repo
-        config = read_config(root)
         original_side = spinner.side
         original_color = spinner.color
         spinner.side = 'right'
         spinner.color = 'cyan'
-        for bincache_server in config['binaryCaches']:
-            url = f'{bincache_server}/{package}.tar.zst'
-            bincache_host = urllib.parse.urlparse(bincache_server).hostname
-            spinner.text = f'{spinner_prefix}Downloading {package} from {bincache_host}'
-            try:
-                sp.run(
-                    ['curl', '--fail', '-L', url, '-o', str(bincache_archive)],
-                    check=True,
-                    stdout=sp.DEVNULL,
-                    stderr=sp.DEVNULL,
-                )
-            except sp.CalledProcessError:
-                spinner.stop()
-                print(spinner.text + ' [FAIL]')
-                spinner.start()
-                continue
-
-            spinner.stop()
-            print(spinner.text + ' [OK]')
-            spinner.start()
-            break
-        else:
-            # Last resort, build it
-            spinner.stop()
-            print(f'Could not download {package} from any binary cache, building it')
-            spinner.start()
-
-            workspace = (root / 'cache' / 'bold' / 'build' / package)
-            phases = ['fetch', 'unpack', 'patch', 'build', 'check', 'install', 'fixup', 'installCheck', 'pack']
-            try:
-                build_packages(
-                    [package], root, workspace, phases,
-                    spinner, db, f'{spinner_prefix}Building package: '
-                )
-            finally:
-                shutil.rmtree(workspace, ignore_errors=True)
-        spinner.side = original_side
-        spinner.color = original_color
-
-    (root / 'app' / package).mkdir(parents=True)
-    sp.call(['tar', '-xf', str(bincache_archive), '-C', str(root / 'app' / package)])
+        partial_archive = bincache_archive.with_name(f'{bincache_archive.name}.partial')
+
+        try:
+            # Prefer patching a version that's already available locally (next to the partial download, which is
+            # only discarded once the patched archive is verified)
+            patched_archive = bincache_archive.with_name(f'{bincache_archive.name}.patched')
+            if fetch_delta(package, root, bincache, patched_archive, spinner, spinner_prefix):
+                discard_partial(partial_archive)
+                patched_archive.rename(bincache_archive)
+            else:
+                for mirror in bincache.ranked(package):
+                    spinner.text = f'{spinner_prefix}Downloading {package} from {mirror.host}'
+                    try:
+                        # Extract while downloading, the archive is kept in the bincache once verified
+                        with mirror.download(f'{package}.tar.zst', partial_archive, mirror.entry(package)) as stream:
+                            _extract(stream, root, package, store)
+                    except (tarfile.TarError, zstandard.ZstdError):
+                        # Corrupt archive, don't resume from it
+                        discard_partial(partial_archive)
+                        spinner.write(spinner.text + ' [FAIL]')
+                        continue
+                    except (OSError, http.client.HTTPException):
+                        # Keeps the partial download, to resume it next time
+                        spinner.write(spinner.text + ' [FAIL]')
+                        continue
+
+                    partial_archive.rename(bincache_archive)
+                    discard_partial(partial_archive)
+                    spinner.write(spinner.text + ' [OK]')
+                    break
+                else:
+                    return False
+        finally:
+            spinner.side = original_side
+            spinner.color = original_color
+
+    if not (root / 'app' / package).exists():
+        with bincache_archive.open('rb') as f:
+            _extract(f, root, package, store)
+    return True
+
+
+def _print_plan(root: Path, bincache: BinaryCache, packages: List[str]):
+    missing = [
+        package for package in packages
+        if not (root / 'app' / package).exists()
+        and not (root / 'cache' / 'bold' / 'bincache' / f'{package}.tar.zst').exists()
+    ]
+    if not missing:
+        return
+
+    plan = bincache.plan(missing)
+    to_download = [package for package in missing if plan[package]]
+    to_build = [package for package in missing if plan[package] is False]
+    unknown = len(missing) - len(to_download) - len(to_build)
+    download_size = sum(bincache.lookup(package).size for package in to_download if bincache.lookup(package))
+    print(f'{len(to_download)} packages to download ({human_size(download_size)}), {len(to_build)} to build locally')
+    if unknown:
+        print(f'{unknown} packages not listed in any binary cache index')
+
+
+def _check_conflicts(manifests: ManifestIndex, bincache: BinaryCache, global_packages: List[str], jobs: int) -> bool:
+    # Packages that will have to be built have no manifest yet, their conflicts only show up in `commit_snapshot`
+    with yaspin(text='Checking for file conflicts'):
+        manifests.fetch(bincache, global_packages, jobs)
+        conflicts = manifests.conflicts(global_packages)
+    if conflicts:
+        print(f'{len(conflicts)} file conflicts, nothing was installed:')
+        for path, packages in conflicts:
+            print(f'- {path} (from {", ".join(packages)})')
+        return False
+    return True
+
+
+def install_packages(packages: List[str], root: Path, db_path: Path, jobs: int, title='Installing packages',
+                     global_packages: Optional[List[str]] = None):
+    # If `global_packages` (the ones merged into the snapshot root) is given, fails early if they would conflict
+    packages = list(dict.fromkeys(packages))
+    _, order = dependency_order(sqlite3.connect(db_path), packages)
+    config = read_config(root)
+    store = ContentStore(root) if config.get('contentStore', False) else None
+    manifests = ManifestIndex(root)
+
+    with manifests, BinaryCache(config['binaryCaches']) as bincache:
+        if global_packages is not None and not _check_conflicts(manifests, bincache, global_packages, jobs):
+            return False
+        _print_plan(root, bincache, order)
+
+        with ProgressBoard(title, len(order)) as board:
+            def install(package):
+                installed = install_package(package, root, board.worker(), bincache, store=store)
+                if installed:
+                    board.advance()
+                return installed
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                missing = [package for package, installed in zip(order, executor.map(install, order)) if not installed]
+
+            # Last resort, build them
+            if missing:
+                board.write(f'Could not download {", ".join(missing)} from any binary cache, building them')
+
+                def after_build(package, status):
+                    status.text = f'Installing {package}'
+                    with (root / 'cache' / 'bold' / 'bincache' / f'{package}.tar.zst').open('rb') as f:
+                        _extract(f, root, package, store)
+
+                build_jobs = config.get('buildJobs', os.cpu_count())
+                if not build_package_graph(missing, root, db_path, build_jobs, board, after_build):
+                    return False
+
+        # Index the manifests of the new packages
+        manifests.load_all(order, jobs)
+
+    if store is not None and store.linked_files:
+        print(f'Reused {store.linked_files} files ({human_size(store.linked_bytes)}) from the content store')
+
     return True
 
 
@@ -95,12 +188,12 @@ def cmd_install(args):
     current_metadata['packages'] |= {pkg: {'global': False} for pkg in dependencies}
     exact_packages += list(dependencies)
 
-    with yaspin(text='') as spinner:
-        # TODO: Parallelize
-        # TODO: Fetch dependencies
-        for package in exact_packages:
-            if not install_package(package, root, db, spinner):
-                return
+    jobs = args.jobs or read_config(root).get('installJobs', 4)
+    global_packages = [pkg for pkg, info in current_metadata['packages'].items() if info['global']]
+    global_packages += list(parsed_packages.values())
+    if not install_packages(exact_packages, root, root / 'snapshot' / 'current' / 'cache.db3', jobs,
+                            global_packages=global_packages):
+        exit(1)
 
     for pkg, exact_pkg in parsed_packages.items():
         current_metadata['packages'][exact_pkg] = {'global': True}
@@ -3,10 +3,25 @@ from pathlib import Path
 
 import sys
 
+from manifests import ManifestIndex
 from snapshots import prepare_snapshot, commit_snapshot, current_snapshot_metadata
+from utils import human_size
 import colorama
 
 
+def _print_files(manifests: ManifestIndex, package: str, gray: str, reset: str):
+    if not manifests.load(package):
+        print(f'  {gray}(no file list, package not installed){reset}')
+        return
+    for entry in manifests.files(package):
+        if entry.type == 'd':
+            print(f'  /{entry.path}/')
+        elif entry.type in 'lL':
+            print(f'  /{entry.path} {gray}-> {entry.digest}{reset}')
+        else:
+            print(f'  /{entry.path} {gray}({human_size(entry.size)}){reset}')
+
+
 def cmd_list(args):
     root = Path(args.root)
 
@@ -37,6 +52,7 @@ def cmd_list(args):
         RESET = ''
 
     matched_any = False
+    manifests = ManifestIndex(root) if args.files else None
 
     for pkg_name, pkg_hash, pkg_desc, pkg_named in packages:
         if pkg_named:
@@ -64,6 +80,9 @@ def cmd_list(args):
               f'{" [" if tags else ""}{",".join(tags)}{"]" if tags else ""}')
         if not args.lines:
             print(f'  {pkg_desc}')
+        if args.files:
+            _print_files(manifests, f'{pkg_name}@{pkg_hash}', GRAY, RESET)
+        if not args.lines:
             print(f'')
         matched_any = True
 
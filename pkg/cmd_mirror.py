@@ -0,0 +1,36 @@
+from pathlib import Path
+
+from yaspin import yaspin
+
+from bincache import INDEX_NAME, write_index
+from deltas import generate_deltas
+from utils import human_size
+
+
+def _bincache_dir(args) -> Path:
+    return Path(args.dir) if args.dir else Path(args.root) / 'cache' / 'bold' / 'bincache'
+
+
+def cmd_mirror_index(args):
+    bincache_dir = _bincache_dir(args)
+
+    with yaspin(text=f'Indexing {bincache_dir}'):
+        count = write_index(bincache_dir)
+
+    print(f'Indexed {count} packages into {bincache_dir / INDEX_NAME}')
+
+
+def cmd_mirror_delta(args):
+    bincache_dir = _bincache_dir(args)
+
+    with yaspin(text=f'Generating deltas in {bincache_dir}'):
+        results = generate_deltas(bincache_dir, args.bases)
+
+    for package, base_package, delta_size, full_size in results:
+        print(f'- {package} from @{base_package.partition("@")[2]}: '
+              f'{human_size(delta_size)} instead of {human_size(full_size)}')
+    print(f'Generated {len(results)} deltas')
+
+    # Clients only look for deltas listed in the index
+    if results and (bincache_dir / INDEX_NAME).exists():
+        cmd_mirror_index(args)
@@ -0,0 +1,91 @@
+import os
+from pathlib import Path
+
+from yaspin import yaspin
+
+from catalog import SnapshotCatalog
+from coldstorage import restore_snapshot
+from snapshots import check_snapshot, replace_link
+from utils import read_config
+
+# Staged by `bold switch --on-reboot`, applied by `bold switch --boot` early during boot.
+# Like `current`, it's a link in `/bold/snapshot`, so gc keeps the snapshot around.
+NEXT_BOOT_LINK = 'next-boot'
+
+
+def _current_id(snapshot_dir: Path):
+    try:
+        return int(os.readlink(snapshot_dir / 'current').rstrip('/').rpartition('/')[2])
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _list_snapshots(catalog: SnapshotCatalog, current_id):
+    for snapshot in catalog.list():
+        marker = '*' if snapshot['id'] == current_id else ' '
+        state = f' [{snapshot["state"]}]' if snapshot['state'] != 'ready' else ''
+        print(f'{marker} {snapshot["id"]:>4}  {snapshot["created"][:19]}  {snapshot["description"]}{state}')
+
+
+def _check(root: Path, catalog: SnapshotCatalog, snapshot_id: int):
+    problems = check_snapshot(root, snapshot_id, catalog.packages(snapshot_id))
+    if problems:
+        print(f'Snapshot {snapshot_id} is broken, not switching to it:')
+        for problem in problems:
+            print(f'- {problem}')
+        exit(1)
+
+
+def _apply_next_boot(root: Path, catalog: SnapshotCatalog):
+    snapshot_dir = root / 'snapshot'
+    if not (snapshot_dir / NEXT_BOOT_LINK).is_symlink():
+        return
+
+    target = os.readlink(snapshot_dir / NEXT_BOOT_LINK)
+    _check(root, catalog, int(target))
+    replace_link(snapshot_dir / 'current', target)
+    (snapshot_dir / NEXT_BOOT_LINK).unlink()
+    print(f'Switched to snapshot {target}')
+
+
+def cmd_switch(args):
+    root = Path(args.root)
+    snapshot_dir = root / 'snapshot'
+
+    if not (snapshot_dir / 'current').exists():
+        print('No snapshots yet, run `bold update` first')
+        return
+
+    with SnapshotCatalog(root) as catalog:
+        if args.boot:
+            _apply_next_boot(root, catalog)
+            return
+
+        if args.generation is None:
+            _list_snapshots(catalog, _current_id(snapshot_dir))
+            return
+
+        if not args.generation.isdigit() or not catalog.exists(int(args.generation)):
+            print(f'No such snapshot: {args.generation}')
+            exit(1)
+        snapshot_id = int(args.generation)
+
+        # Cold snapshots get their packages and root back first, the switch itself is a single rename
+        if catalog.get(snapshot_id)['state'] != 'ready':
+            jobs = args.jobs or read_config(root).get('installJobs', 4)
+            with yaspin(text=f'Restoring snapshot {snapshot_id}'):
+                try:
+                    restore_snapshot(root, catalog, snapshot_id, jobs)
+                except RuntimeError as e:
+                    print(e)
+                    exit(1)
+        _check(root, catalog, snapshot_id)
+
+        if args.on_reboot:
+            replace_link(snapshot_dir / NEXT_BOOT_LINK, str(snapshot_id))
+            print(f'Will switch to snapshot {snapshot_id} on next boot')
+        else:
+            replace_link(snapshot_dir / 'current', str(snapshot_id))
+            # An explicit switch overrides one staged earlier
+            (snapshot_dir / NEXT_BOOT_LINK).unlink(missing_ok=True)
+            print(f'Switched to snapshot {snapshot_id}')
@@ -1,114 +1,315 @@
+import contextlib
 import datetime
 import hashlib
 import json
+import os
 import sqlite3
 import subprocess as sp
+import sys
+import threading
 from pathlib import Path
-from typing import Dict
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
 from yaspin import yaspin
 
-from cmd_install import install_package
-from utils import parse_package_names, read_config, parse_system_names, find_package_deps
-from snapshots import current_snapshot_metadata, prepare_snapshot, commit_snapshot
+from buildcache import tree_digest
+from cmd_install import install_packages
+from utils import hash_file, parse_package_names, read_config, parse_system_names, find_package_deps
+from snapshots import current_snapshot_metadata, prepare_snapshot, commit_snapshot, discard_snapshot
 
 
-def _build_repo(root: Path, config: Dict):
-    repo_dir = (root / config['localRepo']).resolve()
-    repo_main = repo_dir / 'main.js'
-    with yaspin(text='Generating package list'):
+# Generator output is newline-delimited JSON, one record per line:
+#   {"type": "recipe", "id": "<name>@<hash>", "metadata": {...}}   (likewise "system")
+#   {"type": "named_recipe", "name": "<name>", "hash": "<hash>"}   (likewise "named_system")
+# Older generators print the whole repo as a single JSON document instead, it's converted to records.
+RECORD_BATCH_SIZE = 1000
+
+
+def _document_records(document: Dict) -> Iterator[Dict]:
+    for record_type, key in (('recipe', 'recipes'), ('system', 'systems')):
+        for record_id, metadata in document[key].items():
+            yield {'type': record_type, 'id': record_id, 'metadata': metadata}
+    for record_type, key in (('named_recipe', 'named_recipes'), ('named_system', 'named_systems')):
+        for name, record_hash in document[key].items():
+            yield {'type': record_type, 'name': name, 'hash': record_hash}
+
+
+def _read_records(lines: Iterable[bytes], digest, copy: Optional[BinaryIO] = None) -> Iterator[Dict]:
+    # Parses the generator's output as it arrives, hashing it (and copying it to `copy`) on the way
+    for line in lines:
+        digest.update(line)
+        if copy is not None:
+            copy.write(line)
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if 'type' in record:
+            yield record
+        else:
+            yield from _document_records(record)
+
+
+def _repo_digest(repo_dir: Path, qjs: Path) -> str:
+    # Everything the evaluation depends on: the repo's sources and assets (hidden entries like `.git` aside),
+    # and the evaluator itself
+    digest = hashlib.sha256(tree_digest(qjs).encode())
+    for dir_path, dir_names, file_names in os.walk(repo_dir):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+        for name in sorted(name for name in file_names if not name.startswith('.')):
+            path = Path(dir_path) / name
+            digest.update(f'{path.relative_to(repo_dir)}\0'.encode())
+            digest.update(path.read_bytes())
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class _RepoOutput:
+    # The generator's output, from the cache when the repo didn't change since it was last evaluated.
+    # `hash` is only known upfront for cached output, otherwise once `ingest` is done.
+    def __init__(self, root: Path, config: Dict):
+        self.repo_dir = (root / config['localRepo']).resolve()
+        self.qjs = (root / config['quickjsPath'] / 'qjs').resolve()
+        self.cache_dir = root / 'cache' / 'bold' / 'repo'
+        self.cached = self.cache_dir / f'{_repo_digest(self.repo_dir, self.qjs)}.ndjson'
+        self.hash = hash_file(self.cached) if self.cached.exists() else None
+        # Whatever the generator printed to stderr, shown once the spinner is gone
+        self.warnings = ''
+
+    def ingest(self, db_path: Path, previous_db_path: Optional[Path]) -> str:
+        # Fills `db_path` while the generator runs, returns the output's hash
+        digest = hashlib.sha256()
+        if self.hash is not None:
+            with self.cached.open('rb') as f, _CacheLoader(db_path, previous_db_path) as loader:
+                for record in _read_records(f, digest):
+                    loader.add(record)
+            return digest.hexdigest()
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_dir / f'.{self.cached.name}.{os.getpid()}.tmp'
         proc = sp.Popen(
-            [(root / config['quickjsPath'] / 'qjs').resolve(), '-m', str(repo_main)],
-            stdout=sp.PIPE, stderr=sp.PIPE, cwd=str(repo_dir)
+            [self.qjs, '-m', str(self.repo_dir / 'main.js')], stdout=sp.PIPE, stderr=sp.PIPE, cwd=str(self.repo_dir),
         )
-        stdout, stderr = proc.communicate()
-        if stderr:
-            raise RuntimeError(stdout.decode() + '\n' + stderr.decode())
-        return json.loads(stdout), hashlib.sha256(stdout).hexdigest()
+        # Read concurrently, so neither pipe fills up. Warnings on stderr aren't fatal, only the exit status is.
+        stderr = []
+        stderr_reader = threading.Thread(target=lambda: stderr.extend(proc.stderr))
+        stderr_reader.start()
+        try:
+            with tmp_path.open('wb') as copy, _CacheLoader(db_path, previous_db_path) as loader:
+                for record in _read_records(proc.stdout, digest, copy):
+                    loader.add(record)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+            stderr_reader.join()
+            if returncode != 0:
+                tmp_path.unlink(missing_ok=True)
 
+        if returncode != 0:
+            raise RuntimeError(f'Repo generator failed (exit status {returncode}):\n{b"".join(stderr).decode()}')
+        self.warnings = b''.join(stderr).decode()
+
+        # Only the latest evaluation is kept
+        for old in self.cache_dir.iterdir():
+            if not old.name.startswith('.'):
+                old.unlink()
+        tmp_path.rename(self.cached)
+        self.hash = digest.hexdigest()
+        return self.hash
+
+
+# Bump when the `cache.db3` schema changes, databases of older snapshots are then rebuilt rather than updated
+CACHE_SCHEMA_VERSION = 2
+
+
+def _create_cache_schema(db):
+    db.execute('''
+        CREATE TABLE "packages"
+        (
+            "name"              TEXT    NOT NULL,
+            "hash"              TEXT    NOT NULL,
+            "shortdesc"         TEXT    NOT NULL,
+            "metadata"          TEXT    NOT NULL,
+            "recipe"            TEXT,
+            PRIMARY KEY ("name", "hash")
+        );
+    ''')
+    db.execute('''
+        CREATE TABLE "named_packages"
+        (
+            "name"              TEXT    NOT NULL,
+            "hash"              TEXT    NOT NULL,
+            PRIMARY KEY ("name")
+        );
+    ''')
+    db.execute('''
+        CREATE TABLE "systems"
+        (
+            "name"              TEXT    NOT NULL,
+            "hash"              TEXT    NOT NULL,
+            "shortdesc"         TEXT    NOT NULL,
+            "metadata"          TEXT    NOT NULL,
+            PRIMARY KEY ("name", "hash")
+        );
+    ''')
+    db.execute('''
+        CREATE TABLE "named_systems"
+        (
+            "name"              TEXT    NOT NULL,
+            "hash"              TEXT    NOT NULL,
+            PRIMARY KEY ("name")
+        );
+    ''')
+    # Dependency edges between `name@hash` ids, so closures are a query instead of parsing every package's metadata
+    db.execute('''
+        CREATE TABLE "depends"
+        (
+            "package"           TEXT    NOT NULL,
+            "dep"               TEXT    NOT NULL,
+            "kind"              TEXT    NOT NULL,
+            PRIMARY KEY ("package", "kind", "dep")
+        ) WITHOUT ROWID;
+    ''')
+
+
+def _create_cache_indexes(db):
+    # Created after the bulk load, building an index once is cheaper than maintaining it row by row
+    db.execute('CREATE INDEX IF NOT EXISTS "packages_hash" ON "packages" ("hash")')
+    db.execute('CREATE INDEX IF NOT EXISTS "named_packages_hash" ON "named_packages" ("hash", "name")')
+
+
+def _package_row(package_id: str, metadata: Dict) -> Tuple:
+    # The generator already sorts keys, dicts keep that order through `json.loads`/`json.dumps`
+    name, _, package_hash = package_id.partition('@')
+    return (
+        name, package_hash, metadata['shortDesc'],
+        json.dumps({key: value for key, value in metadata.items() if key != 'recipe'}),
+        json.dumps(metadata['recipe']),
+    )
+
+
+def _depends_rows(package_id: str, metadata: Dict) -> List[Tuple]:
+    return [
+        *((package_id, dep, 'runtime') for dep in metadata['depends'].values()),
+        *((package_id, dep, 'build') for dep in metadata['recipe']['buildDepends'].values()),
+    ]
+
+
+def _system_row(system_id: str, metadata: Dict) -> Tuple:
+    name, _, system_hash = system_id.partition('@')
+    return name, system_hash, metadata['shortDesc'], json.dumps(metadata)
 
-def _repo_to_cache(results, db):
-    # Populate cache
-    with db:
-        # Create schema
-        db.execute('''
-            CREATE TABLE "packages"
-            (
-                "name"              TEXT    NOT NULL,
-                "hash"              TEXT    NOT NULL,
-                "shortdesc"         TEXT    NOT NULL,
-                "metadata"          TEXT    NOT NULL,
-                "recipe"            TEXT,
-                PRIMARY KEY ("name", "hash")
-            );
-        ''')
-        db.execute('''
-            CREATE TABLE "named_packages"
-            (
-                "name"              TEXT    NOT NULL,
-                "hash"              TEXT    NOT NULL,
-                PRIMARY KEY ("name")
-            );
-        ''')
-        db.execute('''
-            CREATE TABLE "systems"
-            (
-                "name"              TEXT    NOT NULL,
-                "hash"              TEXT    NOT NULL,
-                "shortdesc"         TEXT    NOT NULL,
-                "metadata"          TEXT    NOT NULL,
-                PRIMARY KEY ("name", "hash")
-            );
-        ''')
-        db.execute('''
-            CREATE TABLE "named_systems"
-            (
-                "name"              TEXT    NOT NULL,
-                "hash"              TEXT    NOT NULL,
-                PRIMARY KEY ("name")
-            );
-        ''')
-
-        # Insert all packages
-        for app_name, app_metadata in results['recipes'].items():
-            app_name, _, app_hash = app_name.partition('@')
-
-            app_recipe = app_metadata['recipe']
-            del app_metadata['recipe']
-
-            db.execute(
-                'INSERT INTO packages (name, hash, shortdesc, metadata, recipe)'
-                'VALUES (?, ?, ?, ?, ?)',
-                (
-                    app_name,
-                    app_hash,
-                    app_metadata['shortDesc'],
-                    json.dumps(app_metadata, sort_keys=True),
-                    json.dumps(app_recipe, sort_keys=True)
-                )
-            )
 
-        # Insert all systems
-        for sys_name, sys_metadata in results['systems'].items():
-            sys_name, _, sys_hash = sys_name.partition('@')
-
-            db.execute(
-                'INSERT INTO systems (name, hash, shortdesc, metadata)'
-                'VALUES (?, ?, ?, ?)',
-                (
-                    sys_name,
-                    sys_hash,
-                    sys_metadata['shortDesc'],
-                    json.dumps(sys_metadata, sort_keys=True),
-                )
+def _clone_cache(previous_db_path: Optional[Path], db_path: Path) -> bool:
+    # Copies the previous snapshot's database (compacted, and consistent even if it's being read), if compatible
+    if previous_db_path is None or not previous_db_path.exists():
+        return False
+    with contextlib.closing(sqlite3.connect(previous_db_path)) as previous:
+        if previous.execute('PRAGMA user_version').fetchone()[0] != CACHE_SCHEMA_VERSION:
+            return False
+        previous.execute('VACUUM INTO ?', (str(db_path),))
+    return True
+
+
+class _CacheLoader:
+    # Writes records to `cache.db3` in batches. Incremental when the previous snapshot's database can be cloned:
+    # only rows for added and removed `name@hash` ids are written. Otherwise built from scratch.
+    INSERTS = {
+        'recipe': 'INSERT INTO packages (name, hash, shortdesc, metadata, recipe) VALUES (?, ?, ?, ?, ?)',
+        'system': 'INSERT INTO systems (name, hash, shortdesc, metadata) VALUES (?, ?, ?, ?)',
+        'named_recipe': 'INSERT OR REPLACE INTO named_packages (name, hash) VALUES (?, ?)',
+        'named_system': 'INSERT OR REPLACE INTO named_systems (name, hash) VALUES (?, ?)',
+        # Several dependency names may resolve to the same package
+        'depends': 'INSERT OR IGNORE INTO depends (package, dep, kind) VALUES (?, ?, ?)',
+    }
+    TABLES = {'recipe': 'packages', 'system': 'systems'}
+
+    def __init__(self, db_path: Path, previous_db_path: Optional[Path] = None):
+        incremental = _clone_cache(previous_db_path, db_path)
+        self.db = sqlite3.connect(db_path)
+        # A snapshot being prepared is discarded if anything fails, it doesn't need a journal or syncs
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('PRAGMA cache_size = -262144')
+        self.db.execute('PRAGMA temp_store = MEMORY')
+        self.db.execute('BEGIN')
+
+        # Ids already in the database, and the ones the generator output (anything else was removed)
+        self.existing = {record_type: set() for record_type in self.TABLES}
+        self.seen = {record_type: set() for record_type in self.TABLES}
+        if incremental:
+            for record_type, table in self.TABLES.items():
+                self.existing[record_type] = {
+                    f'{name}@{row_hash}' for name, row_hash in self.db.execute(f'SELECT name, hash FROM {table}')
+                }
+            # Named entries are few, and can point elsewhere without their target changing
+            self.db.execute('DELETE FROM named_packages')
+            self.db.execute('DELETE FROM named_systems')
+        else:
+            _create_cache_schema(self.db)
+        self.batches = {record_type: [] for record_type in self.INSERTS}
+
+    def add(self, record: Dict):
+        record_type = record['type']
+        if record_type in self.TABLES:
+            record_id = record['id']
+            if record_id in self.seen[record_type]:
+                return
+            self.seen[record_type].add(record_id)
+            if record_id in self.existing[record_type]:
+                return
+            if record_type == 'recipe':
+                row = _package_row(record_id, record['metadata'])
+                self._append('depends', *_depends_rows(record_id, record['metadata']))
+            else:
+                row = _system_row(record_id, record['metadata'])
+        else:
+            row = (record['name'], record['hash'])
+
+        self._append(record_type, row)
+
+    def _append(self, batch_type: str, *rows: Tuple):
+        batch = self.batches[batch_type]
+        batch.extend(rows)
+        if len(batch) >= RECORD_BATCH_SIZE:
+            self._flush(batch_type)
+
+    def _flush(self, batch_type: str):
+        self.db.executemany(self.INSERTS[batch_type], self.batches[batch_type])
+        self.batches[batch_type].clear()
+
+    def finish(self):
+        for batch_type in self.INSERTS:
+            self._flush(batch_type)
+        for record_type, table in self.TABLES.items():
+            removed = self.existing[record_type] - self.seen[record_type]
+            self.db.executemany(
+                f'DELETE FROM {table} WHERE name = ? AND hash = ?',
+                (record_id.split('@', 1) for record_id in removed),
             )
+            if record_type == 'recipe':
+                self.db.executemany('DELETE FROM depends WHERE package = ?', ((record_id,) for record_id in removed))
+        _create_cache_indexes(self.db)
+        self.db.commit()
+        self.db.execute(f'PRAGMA user_version = {CACHE_SCHEMA_VERSION}')
+
+    def __enter__(self):
+        return self
 
-        # Insert all named packages
-        for app_name, app_hash in results['named_recipes'].items():
-            db.execute('INSERT INTO named_packages (name, hash) VALUES (?, ?)', (app_name, app_hash))
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.db.close()
 
-        # Insert all named systems
-        for sys_name, sys_hash in results['named_systems'].items():
-            db.execute('INSERT INTO named_systems (name, hash) VALUES (?, ?)', (sys_name, sys_hash))
+
+def _repo_to_cache(results, db_path: Path, previous_db_path: Optional[Path] = None):
+    # Loads a whole repo document at once
+    with _CacheLoader(db_path, previous_db_path) as loader:
+        for record in _document_records(results):
+            loader.add(record)
 
 
 def get_system_metadata(db, name):
@@ -131,54 +332,65 @@ def get_system_metadata(db, name):
 def cmd_update(args):
     root = Path(args.root)
     config = read_config(root)
-    repo, repo_hash = _build_repo(root, config)
+    repo_output = _RepoOutput(root, config)
     current_metadata = current_snapshot_metadata(root)
-    if current_metadata:
-        # TODO: Compare hash of just package part / just systems part
-        if current_metadata['repoHash'] == repo_hash:
-            print('No updates available')
-            return
+    # TODO: Compare hash of just package part / just systems part
+    if current_metadata and current_metadata['repoHash'] == repo_output.hash:
+        print('No updates available')
+        return
 
     current_metadata['packages'] = {}
     current_metadata['named_packages'] = current_metadata.get('named_packages', {})
 
-    # Prepare snapshot
+    # Prepare snapshot, its package list is filled while the repo is evaluated.
+    # A leftover `next` would block the next update, so it's discarded however this fails.
     snapshot_dir = prepare_snapshot(root)
-    db = sqlite3.connect(snapshot_dir / 'cache.db3')
-    _repo_to_cache(repo, db)
-
-    # Get packages in tracked system
-    next_system_metadata = get_system_metadata(db, config['systemName'])
-    if next_system_metadata:
-        next_sys_packages = set(next_system_metadata['packages'])
-        for package in next_sys_packages:
-            # TODO: Not all pkgs should be global
-            current_metadata['packages'][package] = {'global': True}
-
-    # Add named packages
-    for pkg, exact_pkg in parse_package_names(db, list(current_metadata['named_packages'].keys())).items():
-        current_metadata['packages'][exact_pkg] = current_metadata['named_packages'][pkg]
-
-    # Add dependencies
-    dependencies = find_package_deps(db, list(current_metadata['packages'].keys()))
-    current_metadata['packages'] |= {pkg: {'global': False} for pkg in dependencies}
-
-    # Install missing packages
-    with yaspin(text='') as spinner:
-        total_len = len(current_metadata['packages'])
-        for i, package in enumerate(current_metadata['packages']):
-            if not install_package(package, root, db, spinner, f'[{i+1}/{total_len}]: '):
-                return
+    try:
+        with yaspin(text='Generating package list'):
+            repo_hash = repo_output.ingest(snapshot_dir / 'cache.db3', root / 'snapshot' / 'current' / 'cache.db3')
+        if repo_output.warnings:
+            print(repo_output.warnings, end='', file=sys.stderr)
+        if current_metadata and current_metadata['repoHash'] == repo_hash:
+            discard_snapshot(root)
+            print('No updates available')
+            return
+        db = sqlite3.connect(snapshot_dir / 'cache.db3')
 
-    metadata = {
-        'alias': None,
-        'description': 'Updated from local package repository',
-        'created': datetime.datetime.now().isoformat(),
-        'named_packages': current_metadata['named_packages'],
-        'packages': current_metadata['packages'],
-        'repoHash': repo_hash,
-    }
-    with yaspin(text='Creating snapshot with new updates'):
-        commit_snapshot(root, metadata, switch=True)
+        # Get packages in tracked system
+        next_system_metadata = get_system_metadata(db, config['systemName'])
+        if next_system_metadata:
+            next_sys_packages = set(next_system_metadata['packages'])
+            for package in next_sys_packages:
+                # TODO: Not all pkgs should be global
+                current_metadata['packages'][package] = {'global': True}
+
+        # Add named packages
+        for pkg, exact_pkg in parse_package_names(db, list(current_metadata['named_packages'].keys())).items():
+            current_metadata['packages'][exact_pkg] = current_metadata['named_packages'][pkg]
+
+        # Add dependencies
+        dependencies = find_package_deps(db, list(current_metadata['packages'].keys()))
+        current_metadata['packages'] |= {pkg: {'global': False} for pkg in dependencies}
+
+        # Install missing packages
+        jobs = args.jobs or config.get('installJobs', 4)
+        global_packages = [pkg for pkg, info in current_metadata['packages'].items() if info['global']]
+        if not install_packages(list(current_metadata['packages']), root, snapshot_dir / 'cache.db3', jobs,
+                                global_packages=global_packages):
+            exit(1)
+
+        metadata = {
+            'alias': None,
+            'description': 'Updated from local package repository',
+            'created': datetime.datetime.now().isoformat(),
+            'named_packages': current_metadata['named_packages'],
+            'packages': current_metadata['packages'],
+            'repoHash': repo_hash,
+        }
+        with yaspin(text='Creating snapshot with new updates'):
+            commit_snapshot(root, metadata, switch=True)
+    except BaseException:
+        discard_snapshot(root)
+        raise
 
     print('Done :)')
@@ -0,0 +1,146 @@
+import json
+import os
+import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import zstandard
+
+from archives import pack_archive
+from catalog import SnapshotCatalog
+from cmd_install import install_packages
+from snapshots import build_root
+from utils import CHUNK_SIZE
+
+# Cold snapshots don't keep their root. A `compressed` snapshot keeps its directory with `metadata.json` and
+# `cache.db3`, and relies on the bincache archives of its packages. An `archived` snapshot is a single
+# `/bold/snapshot/<id>.archive.tar` holding `metadata.json`, `cache.db3.zst` and `packages/<package>.tar.zst`.
+# Both are restored (packages reinstalled, root merged again) before switching to them.
+ARCHIVE_SUFFIX = '.archive.tar'
+
+
+def _bincache_archive(root: Path, package: str) -> Path:
+    return root / 'cache' / 'bold' / 'bincache' / f'{package}.tar.zst'
+
+
+def count_inodes(path: Path) -> int:
+    return sum(1 + len(dir_names) + len(file_names) for _, dir_names, file_names in os.walk(path)) - 1
+
+
+def _ensure_archives(root: Path, packages: List[str], jobs: int) -> List[str]:
+    # Packs installed packages missing from the bincache, returns the packages available in neither
+    to_pack = [
+        package for package in packages
+        if not _bincache_archive(root, package).exists() and (root / 'app' / package).is_dir()
+    ]
+    (root / 'cache' / 'bold' / 'bincache').mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(lambda package: pack_archive(root / 'app' / package, _bincache_archive(root, package)), to_pack))
+    return [package for package in packages if not _bincache_archive(root, package).exists()]
+
+
+def _drop_root(snapshot: Path) -> int:
+    # The root is moved aside first, so it's never half deleted in a snapshot still marked `ready`
+    if not (snapshot / 'root').is_dir():
+        return 0
+    (snapshot / 'root').rename(snapshot / '.root.old')
+    return count_inodes(snapshot / '.root.old')
+
+
+def compress_snapshot(root: Path, catalog: SnapshotCatalog, snapshot_id: int, jobs: int) -> int:
+    # Returns the number of inodes removed, packages only used by cold snapshots can be removed from `/bold/app` after
+    snapshot = root / 'snapshot' / str(snapshot_id)
+    missing = _ensure_archives(root, list(catalog.packages(snapshot_id)), jobs)
+    if missing:
+        raise RuntimeError(f'Snapshot {snapshot_id} uses packages that are neither installed nor in the bincache: '
+                           f'{", ".join(missing)}')
+
+    inodes = _drop_root(snapshot)
+    catalog.set_state(snapshot_id, 'compressed')
+    shutil.rmtree(snapshot / '.root.old', ignore_errors=True)
+    return inodes
+
+
+def archive_snapshot(root: Path, catalog: SnapshotCatalog, snapshot_id: int, jobs: int) -> int:
+    snapshot_dir = root / 'snapshot'
+    snapshot = snapshot_dir / str(snapshot_id)
+    packages = sorted(catalog.packages(snapshot_id))
+    missing = _ensure_archives(root, packages, jobs)
+    if missing:
+        raise RuntimeError(f'Snapshot {snapshot_id} uses packages that are neither installed nor in the bincache: '
+                           f'{", ".join(missing)}')
+
+    # Package archives are already compressed, so the outer tar isn't. It can be read as a stream.
+    tmp_archive = snapshot_dir / f'.{snapshot_id}{ARCHIVE_SUFFIX}.tmp'
+    tmp_cache = snapshot_dir / f'.{snapshot_id}.cache.db3.zst.tmp'
+    try:
+        with (snapshot / 'cache.db3').open('rb') as src, tmp_cache.open('wb') as dst:
+            zstandard.ZstdCompressor(level=19, threads=-1).copy_stream(src, dst)
+        with tarfile.open(tmp_archive, 'w', format=tarfile.GNU_FORMAT) as tar:
+            tar.add(snapshot / 'metadata.json', 'metadata.json')
+            tar.add(tmp_cache, 'cache.db3.zst')
+            for package in packages:
+                tar.add(_bincache_archive(root, package), f'packages/{package}.tar.zst')
+        os.rename(tmp_archive, snapshot_dir / f'{snapshot_id}{ARCHIVE_SUFFIX}')
+    finally:
+        tmp_archive.unlink(missing_ok=True)
+        tmp_cache.unlink(missing_ok=True)
+
+    inodes = count_inodes(snapshot)
+    snapshot.rename(snapshot_dir / f'.{snapshot_id}.old')
+    catalog.set_state(snapshot_id, 'archived')
+    shutil.rmtree(snapshot_dir / f'.{snapshot_id}.old')
+    return inodes
+
+
+def _unarchive(root: Path, catalog: SnapshotCatalog, snapshot_id: int, parent):
+    snapshot_dir = root / 'snapshot'
+    archive = snapshot_dir / f'{snapshot_id}{ARCHIVE_SUFFIX}'
+    staging = snapshot_dir / f'.{snapshot_id}.restore'
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+
+    with tarfile.open(archive, 'r|') as tar:
+        for member in tar:
+            if member.name == 'metadata.json':
+                (staging / 'metadata.json').write_bytes(tar.extractfile(member).read())
+            elif member.name == 'cache.db3.zst':
+                with (staging / 'cache.db3').open('wb') as dst:
+                    zstandard.ZstdDecompressor().copy_stream(tar.extractfile(member), dst, write_size=CHUNK_SIZE)
+            elif member.name.startswith('packages/'):
+                bincache_archive = root / 'cache' / 'bold' / 'bincache' / member.name.partition('/')[2]
+                if not bincache_archive.exists():
+                    tmp_path = bincache_archive.with_name(f'.{bincache_archive.name}.restore')
+                    with tmp_path.open('wb') as dst:
+                        shutil.copyfileobj(tar.extractfile(member), dst, CHUNK_SIZE)
+                    tmp_path.rename(bincache_archive)
+
+    if parent is not None and catalog.exists(parent):
+        (staging / 'parent').symlink_to(f'../{parent}')
+    os.rename(staging, snapshot_dir / str(snapshot_id))
+    catalog.set_state(snapshot_id, 'compressed')
+    archive.unlink()
+
+
+def restore_snapshot(root: Path, catalog: SnapshotCatalog, snapshot_id: int, jobs: int):
+    # Brings a compressed or archived snapshot back to a switchable state
+    info = catalog.get(snapshot_id)
+    if info['state'] == 'ready':
+        return
+    if info['state'] == 'archived':
+        _unarchive(root, catalog, snapshot_id, info['parent'])
+
+    snapshot = root / 'snapshot' / str(snapshot_id)
+    with (snapshot / 'metadata.json').open() as f:
+        metadata: Dict = json.load(f)
+    if not install_packages(list(metadata['packages']), root, snapshot / 'cache.db3', jobs, 'Restoring packages'):
+        raise RuntimeError(f'Could not restore the packages of snapshot {snapshot_id}')
+
+    for leftover in ('.root.old', '.root.tmp'):
+        shutil.rmtree(snapshot / leftover, ignore_errors=True)
+    build_root(root, metadata, None, snapshot / '.root.tmp', metadata.get('rootMode', 'hardlink'))
+    (snapshot / '.root.tmp' / 'bold').mkdir(exist_ok=True)
+    (snapshot / '.root.tmp').rename(snapshot / 'root')
+    catalog.set_state(snapshot_id, 'ready')
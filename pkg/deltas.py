@@ -0,0 +1,140 @@
+import hashlib
+import http.client
+import io
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, List, Tuple
+
+import zstandard
+
+from archives import write_reproducible_tar
+from bincache import BinaryCache
+from utils import CHUNK_SIZE
+
+# Deltas are zstd frames compressed with the uncompressed base tar as a raw-content dictionary,
+# i.e. the same format as `zstd --patch-from=<base>.tar <package>.tar`.
+# Mirror layout:
+#   <name>@<hash>.tar.zst                          full archive
+#   deltas/<name>@<hash>/<base hash>.zst           delta from <name>@<base hash>
+#   deltas/<name>@<hash>/tar.sha256                digest of the uncompressed tar, to verify the patched result
+DELTA_LEVEL = 19
+
+
+def _window_log(*sizes: int) -> int:
+    # Both the base and the target must fit in the window for long matches to reach the base
+    return max(zstandard.WINDOWLOG_MIN, min(zstandard.WINDOWLOG_MAX, max(sizes).bit_length() + 1))
+
+
+def make_delta(base_tar: bytes, target_tar: bytes) -> bytes:
+    params = zstandard.ZstdCompressionParameters.from_level(
+        DELTA_LEVEL, window_log=_window_log(len(base_tar), len(target_tar)), enable_ldm=True,
+    )
+    base = zstandard.ZstdCompressionDict(base_tar, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    return zstandard.ZstdCompressor(compression_params=params, dict_data=base).compress(target_tar)
+
+
+def apply_delta(base_tar: bytes, delta: BinaryIO, output: BinaryIO) -> str:
+    # Streams the patched tar to `output`, returns its SHA-256. Only the base (the dictionary) is held in memory.
+    base = zstandard.ZstdCompressionDict(base_tar, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    decompressor = zstandard.ZstdDecompressor(dict_data=base, max_window_size=2 ** zstandard.WINDOWLOG_MAX)
+    digest = hashlib.sha256()
+    with decompressor.stream_reader(delta, closefd=False) as reader:
+        while chunk := reader.read(CHUNK_SIZE):
+            digest.update(chunk)
+            output.write(chunk)
+    return digest.hexdigest()
+
+
+def read_archive(archive: Path) -> bytes:
+    with archive.open('rb') as f:
+        return zstandard.ZstdDecompressor().stream_reader(f).read()
+
+
+def generate_deltas(bincache_dir: Path, max_bases: int) -> List[Tuple[str, str, int, int]]:
+    # For every archive, diff against the newest older versions of the same package name.
+    # A delta is only kept if it is smaller than the full archive.
+    versions = {}
+    for archive in bincache_dir.glob('*@*.tar.zst'):
+        package = archive.name[:-len('.tar.zst')]
+        versions.setdefault(package.partition('@')[0], []).append((archive.stat().st_mtime, package, archive))
+
+    results = []
+    for pkg_name, archives in versions.items():
+        archives.sort()
+        for i, (_, package, archive) in enumerate(archives):
+            delta_dir = bincache_dir / 'deltas' / package
+            bases = [
+                (base_package, base_archive)
+                for _, base_package, base_archive in reversed(archives[:i][-max_bases:])
+                if not (delta_dir / f'{base_package.partition("@")[2]}.zst').exists()
+            ]
+            if not bases:
+                continue
+
+            target_tar = read_archive(archive)
+            for base_package, base_archive in bases:
+                delta = make_delta(read_archive(base_archive), target_tar)
+                if len(delta) >= archive.stat().st_size:
+                    continue
+
+                delta_dir.mkdir(parents=True, exist_ok=True)
+                (delta_dir / 'tar.sha256').write_text(hashlib.sha256(target_tar).hexdigest() + '\n')
+                (delta_dir / f'{base_package.partition("@")[2]}.zst').write_bytes(delta)
+                results.append((package, base_package, len(delta), archive.stat().st_size))
+
+    return results
+
+
+def _local_bases(root: Path, package: str) -> Iterator[Tuple[str, Callable[[], bytes]]]:
+    # Other versions of the package available locally, with a way to get their exact uncompressed tar
+    pkg_name, _, pkg_hash = package.partition('@')
+    seen = set()
+    for archive in sorted((root / 'cache' / 'bold' / 'bincache').glob(f'{pkg_name}@*.tar.zst')):
+        base_hash = archive.name[:-len('.tar.zst')].partition('@')[2]
+        if base_hash != pkg_hash:
+            seen.add(base_hash)
+            yield base_hash, lambda archive=archive: read_archive(archive)
+
+    # Installed packages can be re-packed reproducibly, as long as they weren't modified
+    for app_dir in sorted((root / 'app').glob(f'{pkg_name}@*')):
+        base_hash = app_dir.name.partition('@')[2]
+        if base_hash != pkg_hash and base_hash not in seen:
+            def repack(app_dir=app_dir):
+                tar = io.BytesIO()
+                write_reproducible_tar(app_dir, tar)
+                return tar.getvalue()
+            yield base_hash, repack
+
+
+def fetch_delta(package: str, root: Path, bincache: BinaryCache, archive: Path, spinner, spinner_prefix='') -> bool:
+    # Writes the archive of `package` to `archive`, rebuilt from a local base. False if no usable delta exists.
+    # The patched tar is recompressed as it's decompressed, it's never whole in memory.
+    for base_hash, read_base in _local_bases(root, package):
+        for mirror in bincache.ranked(package):
+            entry = mirror.entry(package)
+            if entry is not None and base_hash not in entry.deltas:
+                continue
+
+            spinner.text = f'{spinner_prefix}Downloading {package} (delta from @{base_hash}) from {mirror.host}'
+            base_tar = read_base()
+            try:
+                with mirror.get(f'deltas/{package}/tar.sha256') as response:
+                    expected_digest = response.read().decode().strip()
+                with mirror.get(f'deltas/{package}/{base_hash}.zst') as response, archive.open('wb') as f:
+                    with zstandard.ZstdCompressor(level=10, threads=-1).stream_writer(f, closefd=False) as writer:
+                        target_digest = apply_delta(base_tar, response, writer)
+            except (OSError, http.client.HTTPException):
+                archive.unlink(missing_ok=True)
+                continue
+            except zstandard.ZstdError:
+                target_digest = None
+
+            if target_digest == expected_digest:
+                spinner.write(spinner.text + ' [OK]')
+                return True
+
+            # The local base doesn't match what the mirror diffed against, other bases may still work
+            archive.unlink(missing_ok=True)
+            spinner.write(spinner.text + ' [MISMATCH]')
+            break
+
+    return False
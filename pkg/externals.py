@@ -0,0 +1,139 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+from buildcache import tree_digest
+from utils import CHUNK_SIZE
+
+# ioctl(dest_fd, FICLONE, src_fd) shares the source's extents (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    # `shutil.copy2` replacement that reflinks when the filesystem supports it
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            # Different filesystems, or no reflink support
+            shutil.copyfileobj(src_file, dst_file, CHUNK_SIZE)
+    shutil.copystat(src, dst)
+    return dst
+
+
+_reflink_support: Dict[int, bool] = {}
+
+
+def reflink_supported(directory: Path) -> bool:
+    # Whether files in `directory` can be reflinked, probed once per filesystem
+    device = os.stat(directory).st_dev
+    if device not in _reflink_support:
+        with tempfile.TemporaryFile(dir=directory) as src, tempfile.TemporaryFile(dir=directory) as dst:
+            src.write(b'\0')
+            src.flush()
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                _reflink_support[device] = True
+            except OSError:
+                _reflink_support[device] = False
+    return _reflink_support[device]
+
+
+def clone_tree(src: Path, dst: Path):
+    # Symlinks are followed, like `shutil.copytree` did when externals were copied directly
+    if src.is_dir():
+        shutil.copytree(src, dst, copy_function=clone_file)
+    else:
+        clone_file(src, dst)
+
+
+def _fingerprint(path: Path) -> str:
+    # Changes whenever a file is added, removed, or modified, without reading any contents
+    digest = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(path) if path.is_dir() else [(str(path.parent), [], [path.name])]:
+        dir_names.sort()
+        for name in sorted(dir_names + file_names):
+            st = os.lstat(os.path.join(dir_path, name))
+            digest.update(f'{dir_path}/{name}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\n'.encode())
+    return digest.hexdigest()
+
+
+class ExternalStager:
+    # Stages local externals into workspaces through a cache of trees keyed by content digest.
+    # The cache lives in `/bold/cache`, on the same filesystem as the workspaces, so workspaces are reflinked from it
+    # even when `/bold/src` is elsewhere. Digests are remembered per source fingerprint, unchanged sources aren't re-read.
+    def __init__(self, root: Path):
+        self.dir = root / 'cache' / 'bold' / 'externals'
+
+    def digest(self, local_path: Path) -> str:
+        # Content digest of `local_path`, recomputed only when its fingerprint changed
+        fingerprint = _fingerprint(local_path)
+        record_path = self.dir / 'fingerprints' / f'{hashlib.sha256(str(local_path).encode()).hexdigest()}.json'
+        try:
+            record = json.loads(record_path.read_text())
+            if record['fingerprint'] == fingerprint:
+                return record['digest']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = tree_digest(local_path)
+        record_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = record_path.with_name(f'.{record_path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps({'path': str(local_path), 'fingerprint': fingerprint, 'digest': digest}))
+        tmp_path.rename(record_path)
+        return digest
+
+    def stage(self, local_path: Path, dest: Path) -> str:
+        # Copies `local_path` to `dest` (sharing data blocks where possible), returns its content digest
+        digest = self.digest(local_path)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        if os.stat(dest.parent).st_dev != os.stat(self.dir).st_dev or not reflink_supported(self.dir):
+            # The cached tree would be a full extra copy, and double the I/O of staging
+            clone_tree(local_path, dest)
+            return digest
+
+        entry = self.dir / 'trees' / digest
+        if not os.path.lexists(entry):
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            staging = Path(tempfile.mkdtemp(prefix=f'.{digest}.', dir=entry.parent))
+            try:
+                clone_tree(local_path, staging / 'tree')
+                try:
+                    os.rename(staging / 'tree', entry)
+                except OSError:
+                    # Another build staged the same tree first
+                    if not os.path.lexists(entry):
+                        raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        clone_tree(entry, dest)
+        return digest
+
+    def stale_entries(self) -> List[Path]:
+        # Trees that aren't the current contents of any staged source anymore (edited or removed since), and the
+        # records of removed sources. Records are written before their tree, so trees being staged are kept.
+        current = set()
+        stale = []
+        for record_path in sorted((self.dir / 'fingerprints').glob('*.json')):
+            try:
+                record = json.loads(record_path.read_text())
+                if os.path.lexists(record['path']):
+                    current.add(record['digest'])
+                    continue
+            except (OSError, ValueError, KeyError):
+                pass
+            stale.append(record_path)
+
+        if (self.dir / 'trees').is_dir():
+            for entry in sorted((self.dir / 'trees').iterdir()):
+                # Staging directories are named `.<digest>.<random>`
+                digest = entry.name[1:].partition('.')[0] if entry.name.startswith('.') else entry.name
+                if digest not in current:
+                    stale.append(entry)
+        return stale
@@ -0,0 +1,170 @@
+import datetime
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
+
+from catalog import SnapshotCatalog
+from externals import ExternalStager
+from manifests import MANIFEST_SUFFIX, ManifestIndex, manifest_path
+
+AGE_UNITS = {
+    'h': datetime.timedelta(hours=1),
+    'd': datetime.timedelta(days=1),
+    'w': datetime.timedelta(weeks=1),
+    'm': datetime.timedelta(days=30),
+    'y': datetime.timedelta(days=365),
+}
+# Directories in `/bold/app` that aren't packages
+APP_INTERNAL_DIRS = ('.store', '.staging')
+
+
+def parse_age(age: str) -> datetime.timedelta:
+    # e.g. `12h`, `2w`
+    count, unit = age[:-1], age[-1:]
+    if unit not in AGE_UNITS or not count.isdigit():
+        raise ValueError(f'Invalid age "{age}", expected a number followed by one of {"/".join(AGE_UNITS)}')
+    return int(count) * AGE_UNITS[unit]
+
+
+def pinned_snapshots(root: Path) -> Set[int]:
+    # Snapshots pointed to by a link in `/bold/snapshot` (`current`, ...) are in use
+    pinned = set()
+    snapshot_dir = root / 'snapshot'
+    for link in snapshot_dir.iterdir():
+        if link.is_symlink():
+            target = os.readlink(link).rstrip('/').rpartition('/')[2]
+            if target.isdigit():
+                pinned.add(int(target))
+    return pinned
+
+
+class GcPlan(NamedTuple):
+    snapshots: List[int]
+    app_dirs: List[Path]
+    archives: List[Path]
+    store_entries: List[Path]
+    external_trees: List[Path]
+    freed: int
+
+
+def _walk_files(path: Path) -> Iterable[os.stat_result]:
+    if not path.is_dir() or path.is_symlink():
+        yield path.lstat()
+        return
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            yield os.lstat(os.path.join(dir_path, name))
+
+
+def _freed_size(paths: List[Path], store_inodes: Dict[int, Path]) -> Tuple[int, List[Path]]:
+    # Data is only freed once all links to it are gone. Store entries only linked from removed paths go too.
+    links = {}
+    for path in paths:
+        for st in _walk_files(path):
+            count, _ = links.get(st.st_ino, (0, st))
+            links[st.st_ino] = (count + 1, st)
+
+    freed = 0
+    store_entries = []
+    for ino, (count, st) in links.items():
+        if ino in store_inodes and count == st.st_nlink - 1:
+            store_entries.append(store_inodes[ino])
+        elif count != st.st_nlink:
+            continue
+        freed += st.st_size
+
+    # Store entries nothing links to anymore
+    for ino, path in store_inodes.items():
+        if ino not in links:
+            st = path.lstat()
+            if st.st_nlink == 1:
+                store_entries.append(path)
+                freed += st.st_size
+    return freed, store_entries
+
+
+def snapshot_paths(root: Path, snapshot_id: int) -> List[Path]:
+    # A snapshot is a directory, or a single file once archived
+    return [
+        path for path in (root / 'snapshot' / str(snapshot_id), root / 'snapshot' / f'{snapshot_id}.archive.tar')
+        if os.path.lexists(path)
+    ]
+
+
+def plan_gc(root: Path, catalog: SnapshotCatalog, remove: Iterable[int], keep_archives: bool) -> GcPlan:
+    # Mark the packages of the kept snapshots (and of the current one, no matter what), sweep the rest.
+    # Only snapshots with a root need their packages in `/bold/app`, compressed ones only need the bincache archives.
+    remove = sorted(set(remove))
+    marked_apps = catalog.referenced_packages(excluding=remove, states=['ready'])
+    marked = catalog.referenced_packages(excluding=remove, states=['ready', 'compressed'])
+    try:
+        with (root / 'snapshot' / 'current' / 'metadata.json').open() as f:
+            current_packages = set(json.load(f)['packages'])
+        marked_apps |= current_packages
+        marked |= current_packages
+    except FileNotFoundError:
+        pass
+
+    app_dirs = [
+        app_dir for app_dir in sorted((root / 'app').iterdir())
+        if app_dir.name not in APP_INTERNAL_DIRS and app_dir.name not in marked_apps
+    ] if (root / 'app').is_dir() else []
+
+    archives = []
+    bincache_dir = root / 'cache' / 'bold' / 'bincache'
+    if not keep_archives and bincache_dir.is_dir():
+        for archive in sorted(bincache_dir.glob('*@*.tar.zst')):
+            package = archive.name[:-len('.tar.zst')]
+            if package not in marked:
+                archives.append(archive)
+                if (bincache_dir / 'deltas' / package).is_dir():
+                    archives.append(bincache_dir / 'deltas' / package)
+                if manifest_path(bincache_dir, package).exists():
+                    archives.append(manifest_path(bincache_dir, package))
+
+    store_inodes = {}
+    store_dir = root / 'app' / '.store'
+    if store_dir.is_dir():
+        for dir_path, dir_names, file_names in os.walk(store_dir):
+            for name in file_names:
+                if not name.startswith('.tmp.'):
+                    path = Path(dir_path) / name
+                    store_inodes[path.lstat().st_ino] = path
+
+    # Staged local sources that were edited or removed since
+    external_trees = ExternalStager(root).stale_entries()
+
+    snapshot_dirs = [path for snapshot_id in remove for path in snapshot_paths(root, snapshot_id)]
+    freed, store_entries = _freed_size(snapshot_dirs + app_dirs + archives + external_trees, store_inodes)
+    return GcPlan(remove, app_dirs, archives, store_entries, external_trees, freed)
+
+
+def _delete(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def sweep(root: Path, catalog: SnapshotCatalog, plan: GcPlan, jobs: int):
+    # Snapshots leave the catalog (and their place) first, so an interrupted sweep never leaves a half deleted snapshot
+    trash = root / 'snapshot' / '.trash'
+    trash.mkdir(exist_ok=True)
+    for snapshot_id in plan.snapshots:
+        for path in snapshot_paths(root, snapshot_id):
+            path.rename(trash / path.name)
+        catalog.remove(snapshot_id)
+
+    # The trash may also hold leftovers of an interrupted sweep
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        garbage = [*trash.iterdir(), *plan.app_dirs, *plan.archives, *plan.store_entries, *plan.external_trees]
+        list(executor.map(_delete, garbage))
+    trash.rmdir()
+
+    with ManifestIndex(root) as manifests:
+        manifests.remove(
+            archive.name[:-len(MANIFEST_SUFFIX)] for archive in plan.archives if archive.name.endswith(MANIFEST_SUFFIX)
+        )
@@ -0,0 +1,198 @@
+import os
+import sqlite3
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Tuple
+
+import zstandard
+
+from bincache import BinaryCache
+from utils import hash_file
+
+# Sorted, zstd compressed TSV of `<type>\t<size>\t<digest>\t<path>` for everything in a package.
+# Types are `d` (directory), `f` (file, the digest is its sha256), `l` (symlink, the digest is its target),
+# and `L` (symlink to a directory, merged into snapshot roots like a directory).
+# Kept next to the archive in the bincache, so mirrors publish them too.
+MANIFEST_SUFFIX = '.files.tsv.zst'
+
+
+class ManifestEntry(NamedTuple):
+    type: str
+    size: int
+    digest: str
+    path: str
+
+
+def manifest_path(bincache_dir: Path, package: str) -> Path:
+    return bincache_dir / f'{package}{MANIFEST_SUFFIX}'
+
+
+def scan_tree(src: Path) -> List[ManifestEntry]:
+    entries = []
+    for dir_path, dir_names, file_names in os.walk(src):
+        rel_dir = os.path.relpath(dir_path, src)
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                # Resolved the same way merging snapshot roots does
+                entries.append(ManifestEntry('L' if os.path.isdir(path) else 'l', 0, os.readlink(path), rel_path))
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append(ManifestEntry('d', 0, '', rel_path))
+            else:
+                entries.append(ManifestEntry('f', st.st_size, hash_file(path), rel_path))
+    return sorted(entries, key=lambda entry: entry.path)
+
+
+def write_manifest(entries: Iterable[ManifestEntry], dest: Path):
+    data = ''.join(f'{entry.type}\t{entry.size}\t{entry.digest}\t{entry.path}\n' for entry in entries).encode()
+    tmp_path = dest.with_name(f'.{dest.name}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(zstandard.ZstdCompressor(level=19).compress(data))
+    tmp_path.rename(dest)
+
+
+def parse_manifest(data: bytes) -> List[ManifestEntry]:
+    entries = []
+    for line in zstandard.ZstdDecompressor().decompressobj().decompress(data).decode().splitlines():
+        entry_type, size, digest, path = line.split('\t', 3)
+        entries.append(ManifestEntry(entry_type, int(size), digest, path))
+    return entries
+
+
+class ManifestIndex:
+    # Manifests of known packages in `/bold/cache/bold/manifests.db3`, to find which package provides what,
+    # and which packages would conflict in a snapshot root, without looking at their archives
+    def __init__(self, root: Path):
+        self.root = root
+        self.bincache_dir = root / 'cache' / 'bold' / 'bincache'
+        self.bincache_dir.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(root / 'cache' / 'bold' / 'manifests.db3')
+        self.db.execute('PRAGMA foreign_keys = ON')
+        with self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS "manifests"
+                (
+                    "package"           TEXT    NOT NULL PRIMARY KEY
+                ) WITHOUT ROWID;
+            ''')
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS "files"
+                (
+                    "package"           TEXT    NOT NULL REFERENCES "manifests" ("package") ON DELETE CASCADE,
+                    "path"              TEXT    NOT NULL,
+                    "type"              TEXT    NOT NULL,
+                    "size"              INTEGER NOT NULL,
+                    "digest"            TEXT    NOT NULL,
+                    PRIMARY KEY ("package", "path")
+                ) WITHOUT ROWID;
+            ''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS "files_path" ON "files" ("path")')
+
+    def has(self, package: str) -> bool:
+        return self.db.execute('SELECT 1 FROM manifests WHERE package = ?', (package,)).fetchone() is not None
+
+    def add(self, package: str, entries: List[ManifestEntry]):
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE package = ?', (package,))
+            self.db.execute('INSERT OR IGNORE INTO manifests (package) VALUES (?)', (package,))
+            self.db.executemany(
+                'INSERT INTO files (package, path, type, size, digest) VALUES (?, ?, ?, ?, ?)',
+                ((package, entry.path, entry.type, entry.size, entry.digest) for entry in entries),
+            )
+
+    def load(self, package: str) -> bool:
+        # Indexes the package from its manifest in the bincache, or from its installed tree (writing the manifest).
+        # False if neither is available yet.
+        if self.has(package):
+            return True
+        manifest = manifest_path(self.bincache_dir, package)
+        if manifest.exists():
+            self.add(package, parse_manifest(manifest.read_bytes()))
+        elif (self.root / 'app' / package).is_dir():
+            entries = scan_tree(self.root / 'app' / package)
+            write_manifest(entries, manifest)
+            self.add(package, entries)
+        else:
+            return False
+        return True
+
+    def load_all(self, packages: Iterable[str], jobs: int):
+        # Like `load`, installed trees without a manifest (installed before manifests existed) are scanned in parallel
+        pending = [package for package in packages if not self.has(package)]
+
+        def scan(package):
+            manifest = manifest_path(self.bincache_dir, package)
+            if not manifest.exists() and (self.root / 'app' / package).is_dir():
+                write_manifest(scan_tree(self.root / 'app' / package), manifest)
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(scan, pending))
+            for package in pending:
+                self.load(package)
+
+    def fetch(self, bincache: BinaryCache, packages: Iterable[str], jobs: int):
+        # Indexes packages not known locally from the manifests mirrors publish, packages to be built have none
+        packages = list(packages)
+        self.load_all(packages, jobs)
+        missing = [package for package in packages if not self.has(package)]
+
+        def fetch(package):
+            data = bincache.fetch(f'{package}{MANIFEST_SUFFIX}', package)
+            if data is not None:
+                manifest = manifest_path(self.bincache_dir, package)
+                tmp_path = manifest.with_name(f'.{manifest.name}.{threading.get_ident()}.tmp')
+                tmp_path.write_bytes(data)
+                tmp_path.rename(manifest)
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(fetch, missing))
+            for package in missing:
+                try:
+                    self.load(package)
+                except (ValueError, zstandard.ZstdError):
+                    # Not a manifest after all
+                    manifest_path(self.bincache_dir, package).unlink()
+
+    def remove(self, packages: Iterable[str]):
+        with self.db:
+            self.db.executemany('DELETE FROM manifests WHERE package = ?', ((package,) for package in packages))
+
+    def files(self, package: str) -> List[ManifestEntry]:
+        return [
+            ManifestEntry(*row)
+            for row in self.db.execute(
+                'SELECT type, size, digest, path FROM files WHERE package = ? ORDER BY path', (package,),
+            )
+        ]
+
+    def conflicts(self, packages: Iterable[str]) -> List[Tuple[str, List[str]]]:
+        # Paths more than one of `packages` provide, unless all of them are directories (those get merged).
+        # Like `MergeConflict`, but known before the packages are even downloaded.
+        with self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS "selected" ("package" TEXT NOT NULL PRIMARY KEY)')
+            self.db.execute('DELETE FROM selected')
+            self.db.executemany('INSERT OR IGNORE INTO selected (package) VALUES (?)', ((package,) for package in packages))
+            return [
+                (path, sorted(providers.split('\t')))
+                for path, providers in self.db.execute('''
+                    SELECT F.path, group_concat(F.package, char(9))
+                    FROM files F JOIN selected USING (package)
+                    GROUP BY F.path
+                    HAVING count(*) > 1 AND sum(F.type NOT IN ('d', 'L')) > 0
+                    ORDER BY F.path
+                ''')
+            ]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,90 @@
+import sys
+import threading
+from typing import Dict
+
+
+class WorkerStatus:
+    # Quacks like a `Yaspin` spinner, so `install_package` and `build_packages` can report through it
+    def __init__(self, board: 'ProgressBoard', index: int):
+        self._board = board
+        self.index = index
+        self.text = ''
+        self.side = 'left'
+        self.color = None
+
+    def write(self, text):
+        self._board.write(text)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class ProgressBoard:
+    # Renders one status line per worker thread, below a header with the overall progress
+    def __init__(self, title: str, total: int, interval=0.1):
+        self.title = title
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self._statuses: Dict[int, WorkerStatus] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._drawn_lines = 0
+        self._tty = sys.stdout.isatty()
+        self._thread = threading.Thread(target=self._render_loop, daemon=True)
+
+    def __enter__(self):
+        if self._tty:
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        if self._tty:
+            self._thread.join()
+            with self._lock:
+                self._clear()
+
+    def worker(self) -> WorkerStatus:
+        # Each worker thread gets its own line
+        ident = threading.get_ident()
+        with self._lock:
+            if ident not in self._statuses:
+                self._statuses[ident] = WorkerStatus(self, len(self._statuses))
+            return self._statuses[ident]
+
+    def advance(self):
+        with self._lock:
+            self.done += 1
+
+    def write(self, text):
+        # Print a permanent line above the status lines
+        with self._lock:
+            self._clear()
+            print(text, flush=True)
+            self._draw()
+
+    def _render_loop(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                self._clear()
+                self._draw()
+
+    def _clear(self):
+        if self._tty and self._drawn_lines:
+            sys.stdout.write(f'\x1b[{self._drawn_lines}F\x1b[J')
+            sys.stdout.flush()
+        self._drawn_lines = 0
+
+    def _draw(self):
+        if not self._tty or self._stopped.is_set():
+            return
+        lines = [f'{self.title} [{self.done}/{self.total}]']
+        for status in sorted(self._statuses.values(), key=lambda s: s.index):
+            lines.append(f'  [{status.index + 1}] {status.text}')
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+        self._drawn_lines = len(lines)
@@ -1,35 +1,237 @@
 import json
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
+from catalog import SnapshotCatalog
+from utils import read_config
+
+
+class MergeConflict(RuntimeError):
+    def __init__(self, conflicts: List[Tuple[str, List[str]]]):
+        self.conflicts = sorted(conflicts)
+        super().__init__('\n'.join(
+            [f'{len(self.conflicts)} file conflicts:'] +
+            [f'- {path} (from {", ".join(sorted(sources))})' for path, sources in self.conflicts]
+        ))
+
+
+def _is_dir_link(path: str) -> bool:
+    # Symlinks to directories are merged like directories. Dangling ones, and loops, are plain symlinks.
+    try:
+        return stat.S_ISDIR(os.stat(path).st_mode)
+    except OSError:
+        return False
 
-# Create a directory that hardlinks from the sources, fails on file conflict
-def create_merged_dir(src_dirs: List[Path], output_dir: Path):
-    output_dir.mkdir()
-    files = {}
 
+def _scan(src_dirs: List[str]) -> Tuple[Dict[str, List[str]], Dict[str, List[Tuple[str, bool]]]]:
+    # One pass over each source, `d_type` tells directories apart without a stat (except for symlinks).
+    # Returns the non-directories (files, symlinks) and the directories (with whether they're symlinks) by name.
+    files = {}
+    dirs = {}
     for src_dir in src_dirs:
-        for entry in src_dir.iterdir():
-            if entry.is_file():
-                if entry.name in files:
-                    raise RuntimeError(f'File conflict: {output_dir}/{entry.name}')
-                files[entry.name] = entry
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.setdefault(entry.name, []).append((entry.path, False))
+                elif entry.is_symlink() and _is_dir_link(entry.path):
+                    dirs.setdefault(entry.name, []).append((entry.path, True))
+                else:
+                    files.setdefault(entry.name, []).append(entry.path)
+    return files, dirs
+
+
+def _link_entries(files: Dict[str, List[str]], dirs: Dict[str, List[Tuple[str, bool]]], output_dir: str,
+                  conflicts: List, symlink: bool = False) -> List[Tuple[List[str], str]]:
+    # Links the files and symlinks, returns the directories left to merge.
+    # With `symlink`, entries are symlinked instead, and so are whole directories only one source provides.
+    subdirs = []
+    for name, paths in files.items():
+        if len(paths) > 1 or name in dirs:
+            conflicts.append((os.path.join(output_dir, name), paths + [path for path, _ in dirs.get(name, [])]))
+        elif symlink:
+            os.symlink(paths[0], os.path.join(output_dir, name))
+        else:
+            os.link(paths[0], os.path.join(output_dir, name), follow_symlinks=False)
+
+    for name, providers in dirs.items():
+        if name in files:
+            continue
+        if len(providers) == 1 and symlink:
+            os.symlink(providers[0][0], os.path.join(output_dir, name))
+        elif len(providers) == 1 and providers[0][1]:
+            # A directory symlink that no other package needs merged into stays a symlink
+            os.link(providers[0][0], os.path.join(output_dir, name), follow_symlinks=False)
+        else:
+            subdirs.append(([path for path, _ in providers], os.path.join(output_dir, name)))
+    return subdirs
+
 
-    for f in files:
-        # print(f'Linking {output_dir}/{f} to {files[f]}')
-        files[f].link_to(output_dir / f)
+def _merge_tree(src_dirs: List[str], output_dir: str, conflicts: List, symlink: bool = False):
+    pending = [(src_dirs, output_dir)]
+    while pending:
+        src_dirs, output_dir = pending.pop()
+        os.mkdir(output_dir)
+        pending.extend(_link_entries(*_scan(src_dirs), output_dir, conflicts, symlink))
 
-    dir_srcs = {}
+
+# Create a directory that hardlinks from the sources, fails on file conflict (after collecting all of them).
+# With `symlink`, it's made of symlinks to the sources instead (like Nix's buildEnv), and only directories
+# provided by several sources are real directories. The sources may then be on another filesystem.
+def create_merged_dir(src_dirs: List[Path], output_dir: Path, jobs: Optional[int] = None, symlink: bool = False):
+    conflicts = []
+    os.mkdir(output_dir)
+    # Symlinks must point to the sources from anywhere
+    src_dirs = [os.path.abspath(src_dir) if symlink else str(src_dir) for src_dir in src_dirs]
+    subdirs = _link_entries(*_scan(src_dirs), str(output_dir), conflicts, symlink)
+
+    # Top-level directories are disjoint, merge them in parallel
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        for future in [executor.submit(_merge_tree, *subdir, conflicts, symlink) for subdir in subdirs]:
+            future.result()
+
+    if conflicts:
+        raise MergeConflict(conflicts)
+
+
+def _link_tree(src_dir: str, output_dir: str):
+    # Hardlink copy of a merged root subtree
+    os.mkdir(output_dir)
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _link_tree(entry.path, os.path.join(output_dir, entry.name))
+            else:
+                os.link(entry.path, os.path.join(output_dir, entry.name), follow_symlinks=False)
+
+
+def _package_tree(src_dirs: List[Path]) -> Dict:
+    # Names provided by the packages, nested dicts for directories and None for files
+    tree = {}
     for src_dir in src_dirs:
-        for entry in src_dir.iterdir():
-            if entry.is_dir():
-                if entry.name not in dir_srcs:
-                    dir_srcs[entry.name] = []
-                dir_srcs[entry.name].append(entry)
+        for dir_path, dir_names, file_names in os.walk(src_dir, followlinks=True):
+            node = tree
+            for part in Path(dir_path).relative_to(src_dir).parts:
+                node = node.setdefault(part, {})
+            for name in dir_names:
+                node.setdefault(name, {})
+            for name in file_names:
+                node[name] = None
+    return tree
+
+
+def _kept_providers(kept_dirs: List[Path], rel_path: str, name: str) -> Tuple[List[str], List[Tuple[str, bool]]]:
+    # What the kept packages provide at `rel_path/name`, classified like `_scan` does
+    files = []
+    dirs = []
+    for kept_dir in kept_dirs:
+        path = os.path.join(kept_dir, rel_path, name)
+        if not os.path.lexists(path):
+            continue
+        if os.path.islink(path):
+            if _is_dir_link(path):
+                dirs.append((path, True))
+            else:
+                files.append(path)
+        elif os.path.isdir(path):
+            dirs.append((path, False))
+        else:
+            files.append(path)
+    return files, dirs
+
 
-    for dir in dir_srcs:
-        # print(f'Recursing into {dir}')
-        create_merged_dir(dir_srcs[dir], output_dir / dir)
+def _update_tree(parent_dir: str, output_dir: str, added_dirs: List[str], removed: Dict, kept_dirs: List[Path],
+                 rel_path: str, conflicts: List):
+    # Names no added or removed package provides are linked from the parent as is. The others are merged again from
+    # their new providers, like `create_merged_dir` would, recursing where the parent already has them merged.
+    os.mkdir(output_dir)
+    added_files, added_subdirs = _scan(added_dirs)
+    touched = set(added_files) | set(added_subdirs) | set(removed)
+
+    parent_dirs = set()
+    with os.scandir(parent_dir) as entries:
+        for entry in entries:
+            if entry.name in touched:
+                if entry.is_dir(follow_symlinks=False):
+                    parent_dirs.add(entry.name)
+            elif entry.is_dir(follow_symlinks=False):
+                _link_tree(entry.path, os.path.join(output_dir, entry.name))
+            else:
+                os.link(entry.path, os.path.join(output_dir, entry.name), follow_symlinks=False)
+
+    for name in sorted(touched):
+        files, dirs = _kept_providers(kept_dirs, rel_path, name)
+        files += added_files.get(name, [])
+        dirs += added_subdirs.get(name, [])
+        subdirs = _link_entries({name: files} if files else {}, {name: dirs} if dirs else {}, output_dir, conflicts)
+        for sources, dest in subdirs:
+            if name in parent_dirs:
+                _update_tree(
+                    os.path.join(parent_dir, name), dest, [path for path, _ in added_subdirs.get(name, [])],
+                    removed.get(name) or {}, kept_dirs, os.path.join(rel_path, name), conflicts,
+                )
+            else:
+                _merge_tree(sources, dest, conflicts)
+
+
+def update_merged_dir(parent_dir: Path, output_dir: Path, added_dirs: List[Path], removed: Dict,
+                      kept_dirs: List[Path]):
+    # Same result as `create_merged_dir` over the new package set, built from the parent's merged directory:
+    # subtrees no added or removed package touches are hardlinked as is, the rest is merged again
+    conflicts = []
+    _update_tree(str(parent_dir), str(output_dir), [str(d) for d in added_dirs], removed, kept_dirs, '.', conflicts)
+    if conflicts:
+        raise MergeConflict(conflicts)
+
+
+def _global_packages(metadata: Dict) -> List[str]:
+    return [package for package, info in metadata['packages'].items() if info['global']]
+
+
+def root_mode(root: Path) -> str:
+    # `hardlink`: roots hardlink every file of the global packages.
+    # `symlink`: roots symlink into `/bold/app`, down to where packages overlap.
+    mode = read_config(root).get('snapshotRoots', 'hardlink')
+    if mode not in ('hardlink', 'symlink'):
+        raise ValueError(f'Invalid snapshotRoots "{mode}" in config, expected "hardlink" or "symlink"')
+    return mode
+
+
+def build_root(root: Path, metadata: Dict, parent: Optional[Path], output_dir: Path, mode: Optional[str] = None):
+    new_packages = _global_packages(metadata)
+    config = read_config(root)
+    mode = mode or root_mode(root)
+    parent_metadata = None
+    # Symlinked roots are about as cheap to create from scratch, they're never built from the parent's
+    if parent is not None and mode == 'hardlink' and config.get('incrementalSnapshots', True):
+        try:
+            with (parent / 'metadata.json').open() as f:
+                parent_metadata = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    if parent_metadata is None or parent_metadata.get('rootMode', 'hardlink') != mode or not (parent / 'root').is_dir():
+        create_merged_dir([root / 'app' / package for package in new_packages], output_dir, symlink=mode == 'symlink')
+        return
+
+    parent_packages = set(_global_packages(parent_metadata))
+    added = [package for package in new_packages if package not in parent_packages]
+    removed = parent_packages.difference(new_packages)
+    kept = [package for package in new_packages if package in parent_packages]
+    try:
+        update_merged_dir(
+            parent / 'root', output_dir,
+            [root / 'app' / package for package in added],
+            _package_tree([root / 'app' / package for package in removed]),
+            [root / 'app' / package for package in kept],
+        )
+    except MergeConflict:
+        # Reported against the packages themselves, like a root built from scratch
+        shutil.rmtree(output_dir)
+        create_merged_dir([root / 'app' / package for package in new_packages], output_dir)
 
 
 def prepare_snapshot(root: Path, parent=None):
@@ -43,34 +245,61 @@ def prepare_snapshot(root: Path, parent=None):
     return snapshot_dir / 'next'
 
 
+def discard_snapshot(root: Path):
+    shutil.rmtree(root / 'snapshot' / 'next', ignore_errors=True)
+
+
 def commit_snapshot(root: Path, metadata: Dict, parent=None, switch=False):
     snapshot_dir = root / 'snapshot'
 
-    # Write metadata
-    with (snapshot_dir / 'next' / 'metadata.json').open('w') as f:
-        f.write(json.dumps(metadata, sort_keys=True))
+    try:
+        # Write metadata
+        metadata = {**metadata, 'rootMode': root_mode(root)}
+        with (snapshot_dir / 'next' / 'metadata.json').open('w') as f:
+            f.write(json.dumps(metadata, sort_keys=True))
 
-    # Generate root
-    create_merged_dir([
-        root / 'app' / package
-        for package in metadata['packages']
-        if metadata['packages'][package]['global']
-    ], snapshot_dir / 'next' / 'root')
-    (snapshot_dir / 'next' / 'root' / 'bold').mkdir()
+        # Generate root, from the current snapshot's root when possible
+        current = snapshot_dir / 'current'
+        build_root(root, metadata, current.resolve() if current.is_symlink() else None, snapshot_dir / 'next' / 'root')
+        (snapshot_dir / 'next' / 'root' / 'bold').mkdir(exist_ok=True)
+    except BaseException:
+        # A leftover `next` would block the next `prepare_snapshot`
+        discard_snapshot(root)
+        raise
 
     # Add snapshot to tree
-    if (snapshot_dir / 'current').is_symlink():
-        current_id = (snapshot_dir / 'current').readlink()
-        highest_id = max(int(snap.name) for snap in snapshot_dir.iterdir() if snap.name.isdigit())
-        next_id = str(highest_id + 1)
-        (snapshot_dir / 'next').rename(snapshot_dir / next_id)
-        (snapshot_dir / next_id / 'parent').symlink_to(f'../{current_id}')
-        if switch:
-            (snapshot_dir / 'current').unlink()
-            (snapshot_dir / 'current').symlink_to(str(next_id))
-    else:
-        (snapshot_dir / 'next').rename(snapshot_dir / '1')
-        (snapshot_dir / 'current').symlink_to('1')
+    with SnapshotCatalog(root) as catalog:
+        if (snapshot_dir / 'current').is_symlink():
+            current_id = (snapshot_dir / 'current').readlink()
+            next_id = str(catalog.add(snapshot_dir / 'next', int(current_id.name), metadata))
+            (snapshot_dir / next_id / 'parent').symlink_to(f'../{current_id}')
+            if switch:
+                replace_link(snapshot_dir / 'current', next_id)
+        else:
+            next_id = str(catalog.add(snapshot_dir / 'next', None, metadata))
+            replace_link(snapshot_dir / 'current', next_id)
+
+    return int(next_id)
+
+
+def replace_link(link: Path, target: str):
+    # A new symlink renamed over the old one, readers see either the old or the new target, never no link at all
+    tmp_link = link.with_name(f'.{link.name}.{os.getpid()}.tmp')
+    tmp_link.unlink(missing_ok=True)
+    tmp_link.symlink_to(target)
+    os.rename(tmp_link, link)
+
+
+def check_snapshot(root: Path, snapshot_id: int, packages: Dict[str, bool]) -> List[str]:
+    # Everything a snapshot needs to be switched to, returns what's missing
+    snapshot = root / 'snapshot' / str(snapshot_id)
+    problems = [
+        f'missing {path}'
+        for path in (snapshot / 'metadata.json', snapshot / 'cache.db3', snapshot / 'root')
+        if not path.exists()
+    ]
+    problems += [f'package {package} is not installed' for package in sorted(packages) if not (root / 'app' / package).is_dir()]
+    return problems
 
 
 def current_snapshot_metadata(root: Path) -> Dict:
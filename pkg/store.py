@@ -0,0 +1,133 @@
+import hashlib
+import os
+import stat
+import tarfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from utils import CHUNK_SIZE, hash_file
+
+# Files up to this size are hashed in memory before touching the disk, so duplicates are never written
+MAX_BUFFERED_SIZE = 16 * 1024 * 1024
+
+
+def _key(digest: str, mode: int) -> str:
+    # Hardlinks share permissions, so the mode is part of the key
+    return f'{digest}-{stat.S_IMODE(mode):o}'
+
+
+class ContentStore:
+    # Content-addressed store of package files under `/bold/app/.store`.
+    # Package trees hardlink into it, so identical files across versions take space only once.
+    # A store entry with a single link isn't used by any package anymore.
+    def __init__(self, root: Path):
+        self.dir = root / 'app' / '.store'
+        self.linked_files = 0
+        self.linked_bytes = 0
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> Path:
+        return self.dir / key[:2] / key
+
+    def _add(self, tmp_path: Path, key: str) -> Path:
+        stored = self.path(key)
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(tmp_path, stored)
+        except FileExistsError:
+            # Another worker stored the same content first
+            pass
+        return stored
+
+    def _record(self, size: int):
+        with self._lock:
+            self.linked_files += 1
+            self.linked_bytes += size
+
+    def _tmp_file(self, mode: int):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', dir=self.dir)
+        os.fchmod(fd, stat.S_IMODE(mode))
+        return os.fdopen(fd, 'wb'), Path(tmp_path)
+
+    def extract_file(self, tar: tarfile.TarFile, member: tarfile.TarInfo, dest_dir: Path) -> str:
+        # Extract a regular file from the tar as a hardlink into the store, returns the sha256 of its contents
+        dest = dest_dir / member.name
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        src = tar.extractfile(member)
+        data = src.read(MAX_BUFFERED_SIZE + 1)
+
+        if len(data) <= MAX_BUFFERED_SIZE:
+            digest = hashlib.sha256(data)
+            key = _key(digest.hexdigest(), member.mode)
+            if self.path(key).exists():
+                os.link(self.path(key), dest)
+                self._record(member.size)
+                return digest.hexdigest()
+            f, tmp_path = self._tmp_file(member.mode)
+            with f:
+                f.write(data)
+        else:
+            # Too big to buffer, hash while writing
+            digest = hashlib.sha256(data)
+            f, tmp_path = self._tmp_file(member.mode)
+            with f:
+                f.write(data)
+                while data := src.read(CHUNK_SIZE):
+                    digest.update(data)
+                    f.write(data)
+            key = _key(digest.hexdigest(), member.mode)
+            if self.path(key).exists():
+                self._record(member.size)
+
+        try:
+            os.utime(tmp_path, (member.mtime, member.mtime))
+            os.link(self._add(tmp_path, key), dest)
+        finally:
+            tmp_path.unlink()
+        return digest.hexdigest()
+
+    def dedup_file(self, path: Path) -> int:
+        # Replace a file with a hardlink into the store, returns the bytes freed
+        st = path.lstat()
+        stored = self._add(path, _key(hash_file(path), st.st_mode))
+        stored_st = stored.lstat()
+        if stored_st.st_ino == st.st_ino and stored_st.st_dev == st.st_dev:
+            return 0
+
+        # Atomically swap the file for a link to the stored copy
+        tmp_link = path.with_name(f'.{path.name}.bold-dedup')
+        os.link(stored, tmp_link)
+        os.replace(tmp_link, path)
+        self._record(st.st_size)
+        return st.st_size if st.st_nlink == 1 else 0
+
+    def dedup_tree(self, tree: Path, jobs: int) -> int:
+        def regular_files() -> Iterator[Path]:
+            for dir_path, dir_names, file_names in os.walk(tree):
+                dir_names[:] = [d for d in dir_names if d not in ('.store', '.staging')]
+                for name in file_names:
+                    path = Path(dir_path) / name
+                    if stat.S_ISREG(path.lstat().st_mode):
+                        yield path
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return sum(executor.map(self.dedup_file, regular_files()))
+
+
+def app_usage(root: Path) -> Tuple[int, int]:
+    # Apparent and actual size of all installed packages, excluding hardlinks within `/bold/app`
+    apparent = actual = 0
+    seen_inodes = set()
+    for dir_path, dir_names, file_names in os.walk(root / 'app'):
+        dir_names[:] = [d for d in dir_names if d not in ('.store', '.staging')]
+        for name in file_names:
+            st = os.lstat(os.path.join(dir_path, name))
+            apparent += st.st_size
+            if st.st_ino not in seen_inodes:
+                seen_inodes.add(st.st_ino)
+                actual += st.st_size
+    return apparent, actual
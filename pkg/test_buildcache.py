@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import externals
+from buildcache import PhaseCache
+
+PHASES = ['unpack', 'build', 'install']
+
+
+def _recipes(build_cmd='make'):
+    return {'a@1': {
+        'phases': {'unpack': {'cmd': 'tar xf src.tar'}, 'build': {'cmd': build_cmd}, 'install': {'cmd': 'make install'}},
+        'buildDepends': {},
+    }}
+
+
+class PhaseCacheWithoutReflinksTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.root = self.dir / 'bold'
+        self.workspace = self.root / 'cache' / 'bold' / 'build' / 'a@1'
+        self.workspace.mkdir(parents=True)
+        (self.workspace / 'activate.sh').write_text('')
+        # Like ext4 or overlayfs
+        externals._reflink_support[os.stat(self.dir).st_dev] = False
+
+    def tearDown(self):
+        externals._reflink_support.clear()
+        shutil.rmtree(self.dir)
+
+    def _cache(self, build_cmd='make', external_digest='src1'):
+        cache = PhaseCache(self.root, ['a@1'], self.workspace)
+        cache.compute_keys(PHASES, _recipes(build_cmd), {'a@1': {'depends': {}}}, {'a@1.src': external_digest})
+        return cache
+
+    def _fail_after(self, completed):
+        # A build that completed `completed` and failed in the phase after it
+        cache = self._cache()
+        self.assertEqual(cache.restore(PHASES), PHASES)
+        for phase in completed:
+            (self.workspace / phase).write_text(phase)
+            cache.save(phase)
+        (self.workspace / 'partial').write_text('')
+
+    def test_resumes_in_place(self):
+        self._fail_after(['unpack', 'build'])
+        self.assertEqual(self._cache().restore(PHASES), ['install'])
+        self.assertEqual(sorted(os.listdir(self.workspace)), ['.bold-phase', 'activate.sh', 'build', 'partial', 'unpack'])
+
+    def test_reruns_failed_phase(self):
+        self._fail_after(['unpack'])
+        self.assertEqual(self._cache().restore(PHASES), ['build', 'install'])
+
+    def test_changed_phase_reruns_from_scratch(self):
+        self._fail_after(['unpack', 'build'])
+        self.assertEqual(self._cache(build_cmd='make -j').restore(PHASES), PHASES)
+        self.assertEqual(os.listdir(self.workspace), ['activate.sh'])
+
+    def test_changed_external_reruns_from_scratch(self):
+        self._fail_after(['unpack', 'build'])
+        self.assertEqual(self._cache(external_digest='src2').restore(PHASES), PHASES)
+        self.assertEqual(os.listdir(self.workspace), ['activate.sh'])
+
+    def test_no_snapshot_taken(self):
+        self._fail_after(['unpack', 'build'])
+        self.assertEqual(sorted(os.listdir(self._cache().dir)), ['keys.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
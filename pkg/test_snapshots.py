@@ -0,0 +1,117 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from snapshots import MergeConflict, _package_tree, create_merged_dir, update_merged_dir
+
+NAMES = ['bin', 'lib', 'share', 'x', 'y']
+
+
+def _make_tree(rng: random.Random, path: Path, depth: int):
+    path.mkdir(parents=True)
+    for name in rng.sample(NAMES, rng.randint(0, 3)):
+        kind = rng.choice(['file', 'file', 'dir', 'dir', 'dir', 'dirlink', 'filelink', 'dangling', 'loop'])
+        if depth == 0 and kind == 'dir':
+            kind = 'file'
+        if kind == 'file':
+            (path / name).write_text(f'{path}/{name}')
+        elif kind == 'dir':
+            _make_tree(rng, path / name, depth - 1)
+        elif kind == 'dirlink':
+            (path / f'.{name}.target').mkdir()
+            (path / f'.{name}.target' / 'inside').write_text(str(path))
+            (path / name).symlink_to(f'.{name}.target')
+        elif kind == 'filelink':
+            (path / name).symlink_to('/etc/hostname')
+        elif kind == 'dangling':
+            (path / name).symlink_to('nonexistent')
+        else:
+            (path / name).symlink_to(name)
+
+
+def _describe(root: Path):
+    # Every entry with what it is, hardlinks by inode
+    tree = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            st = os.lstat(path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                tree[os.path.relpath(path, root)] = 'dir'
+            else:
+                tree[os.path.relpath(path, root)] = st.st_ino
+    return tree
+
+
+class IncrementalRootTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _build(self, packages, name):
+        output = self.dir / name
+        try:
+            create_merged_dir([self.dir / 'app' / package for package in packages], output)
+            return _describe(output)
+        except MergeConflict:
+            return None
+
+    def test_directory_becomes_file(self):
+        for package, path in (('A', 'lib/x'), ('K', 'bin/k')):
+            (self.dir / 'app' / package / path).parent.mkdir(parents=True)
+            (self.dir / 'app' / package / path).write_text(package)
+        (self.dir / 'app' / 'B').mkdir()
+        (self.dir / 'app' / 'B' / 'lib').write_text('B')
+
+        create_merged_dir([self.dir / 'app' / 'A', self.dir / 'app' / 'K'], self.dir / 'parent')
+        update_merged_dir(
+            self.dir / 'parent', self.dir / 'inc', [self.dir / 'app' / 'B'],
+            _package_tree([self.dir / 'app' / 'A']), [self.dir / 'app' / 'K'],
+        )
+        self.assertEqual(_describe(self.dir / 'inc'), self._build(['B', 'K'], 'full'))
+
+    def test_symlink_loop(self):
+        (self.dir / 'app' / 'A' / 'bin').mkdir(parents=True)
+        (self.dir / 'app' / 'A' / 'bin' / 'loop').symlink_to('loop')
+        (self.dir / 'app' / 'B' / 'bin').mkdir(parents=True)
+        (self.dir / 'app' / 'B' / 'bin' / 'b').write_text('B')
+
+        self.assertEqual(os.readlink(self.dir / 'app' / 'A' / 'bin' / 'loop'), 'loop')
+        root = self._build(['A', 'B'], 'full')
+        self.assertEqual(root['bin/loop'], os.lstat(self.dir / 'app' / 'A' / 'bin' / 'loop').st_ino)
+
+    def test_same_as_full_merge(self):
+        rng = random.Random(1234)
+        for round_number in range(300):
+            with self.subTest(round=round_number):
+                shutil.rmtree(self.dir)
+                self.dir.mkdir()
+                packages = [f'p{i}' for i in range(rng.randint(2, 6))]
+                for package in packages:
+                    _make_tree(rng, self.dir / 'app' / package, 2)
+                old = rng.sample(packages, rng.randint(1, len(packages)))
+                new = rng.sample(packages, rng.randint(1, len(packages)))
+                if self._build(old, 'parent') is None:
+                    continue
+
+                expected = self._build(new, 'full')
+                try:
+                    update_merged_dir(
+                        self.dir / 'parent', self.dir / 'inc',
+                        [self.dir / 'app' / package for package in new if package not in old],
+                        _package_tree([self.dir / 'app' / package for package in old if package not in new]),
+                        [self.dir / 'app' / package for package in new if package in old],
+                    )
+                    actual = _describe(self.dir / 'inc')
+                except MergeConflict:
+                    actual = None
+                self.assertEqual(actual, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,33 @@
+import hashlib
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, List, Set
 import toml
 
+CHUNK_SIZE = 1024 * 1024
+
 
 def read_config(root: Path):
     return toml.load(root / 'config.toml')
 
 
+def hash_file(path, digest=None) -> str:
+    # Hex sha256 of a file's contents, read in chunks. Given a `digest`, the contents are added to it instead.
+    if digest is None:
+        digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while data := f.read(CHUNK_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def human_size(size: float) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TiB'
+
+
 def parse_package_names(db, packages: List[str]):
     invalid_packages = [p for p in packages if p.count('@') >= 2]
 
@@ -145,19 +166,85 @@ def parse_system_names(db, systems: List[str]):
     return exact_systems
 
 
-def find_package_deps(db, packages, visited=None, dependencies=None):
-    from building import get_metadata
+# Edge kinds in the `depends` table of `cache.db3`: `runtime` for `depends`, `build` for `recipe.buildDepends`
+RUNTIME_DEPS = ('runtime',)
+ALL_DEPS = ('runtime', 'build')
 
-    if visited is None:
-        visited = set()
-    if dependencies is None:
+
+def _has_depends_table(db) -> bool:
+    # Snapshots created before the table existed keep their own `cache.db3`
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'depends'").fetchone() is not None
+
+
+def _metadata_deps(db, package: str, kinds: List[str]) -> Set[str]:
+    from building import get_metadata, get_recipe
+
+    deps = set()
+    if 'runtime' in kinds:
+        deps |= set(get_metadata(db, package)['depends'].values())
+    if 'build' in kinds:
+        deps |= set(get_recipe(db, package)['buildDepends'].values())
+    return deps
+
+
+def _fill_wanted_deps(db, packages: List[str]):
+    db.execute('DROP TABLE IF EXISTS wanted_deps')
+    db.execute('''
+        CREATE TEMPORARY TABLE "wanted_deps"
+        (
+            "package"           TEXT    NOT NULL PRIMARY KEY
+        ) WITHOUT ROWID
+    ''')
+    db.executemany('INSERT OR IGNORE INTO wanted_deps (package) VALUES (?)', ((package,) for package in packages))
+
+
+def package_deps(db, packages: Iterable[str], kinds: Iterable[str] = ALL_DEPS) -> Dict[str, Set[str]]:
+    # Direct dependencies of each of `packages`
+    packages = list(packages)
+    kinds = list(kinds)
+    if not _has_depends_table(db):
+        return {package: _metadata_deps(db, package, kinds) for package in packages}
+
+    deps = {package: set() for package in packages}
+    with db:
+        _fill_wanted_deps(db, packages)
+        for package, dep in db.execute(f'''
+            SELECT D.package, D.dep
+            FROM depends D JOIN wanted_deps USING (package)
+            WHERE D.kind IN ({', '.join('?' * len(kinds))})
+        ''', kinds):
+            deps[package].add(dep)
+    return deps
+
+
+def find_package_deps(db, packages: Iterable[str], kinds: Iterable[str] = RUNTIME_DEPS) -> Set[str]:
+    # Transitive dependencies of `packages` (not including them, unless one depends on another)
+    packages = list(packages)
+    kinds = list(kinds)
+    if not _has_depends_table(db):
+        # Walked iteratively, each package's metadata is only loaded once
         dependencies = set()
-    for pkg in packages:
-        if pkg in visited:
-            continue
-        pkg_deps = set(get_metadata(db, pkg)['depends'].values())
-        dependencies |= pkg_deps
-        for dep in pkg_deps:
-            dependencies |= find_package_deps(db, [dep], visited, dependencies)
-        visited.add(pkg)
-    return dependencies
+        visited = set()
+        pending = list(packages)
+        while pending:
+            package = pending.pop()
+            if package in visited:
+                continue
+            visited.add(package)
+            pkg_deps = _metadata_deps(db, package, kinds)
+            dependencies |= pkg_deps
+            pending.extend(pkg_deps - visited)
+        return dependencies
+
+    placeholders = ', '.join('?' * len(kinds))
+    with db:
+        _fill_wanted_deps(db, packages)
+        # `UNION` skips packages already in the closure, so cycles end the recursion
+        return {row[0] for row in db.execute(f'''
+            WITH RECURSIVE closure(package) AS (
+                SELECT D.dep FROM depends D JOIN wanted_deps USING (package) WHERE D.kind IN ({placeholders})
+                UNION
+                SELECT D.dep FROM depends D JOIN closure C USING (package) WHERE D.kind IN ({placeholders})
+            )
+            SELECT package FROM closure
+        ''', kinds + kinds)}
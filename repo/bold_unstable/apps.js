@@ -18,7 +18,8 @@ export const busybox = ({}) => {
                     cmd: '',
                 },
                 build: {
-                    cmd: 'cd "$EXT_src" && make -j8',
+                    // No -j, `make` gets its job slots from bold's jobserver through MAKEFLAGS
+                    cmd: 'cd "$EXT_src" && make',
                 },
                 check: {
                     cmd: '',
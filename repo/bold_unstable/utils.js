@@ -1,5 +1,3 @@
-import * as os from "os";
-import * as std from "std";
 import * as apps from "./apps.js";
 
 // Seems to work
@@ -18,32 +16,136 @@ function sortedJsonStringify(obj) {
     return JSON.stringify(obj, allKeys);
 }
 
-// XXX: Will deadlock on long inputs
-function run_cmd(cmd, input) {
-    let [in_read_fd, in_write_fd] = os.pipe();
-    let [out_read_fd, out_write_fd] = os.pipe();
-    let proc = os.exec(cmd, {
-        block: false,
-        stdin: in_read_fd,
-        stdout: out_write_fd,
-    });
-    os.close(in_read_fd);
-    os.close(out_write_fd);
+function utf8Encode(str) {
+    let bytes = [];
+    for (const char of str) {
+        let code = char.codePointAt(0);
+        if (code < 0x80) {
+            bytes.push(code);
+        } else if (code < 0x800) {
+            bytes.push(0xc0 | (code >> 6), 0x80 | (code & 0x3f));
+        } else if (code < 0x10000) {
+            bytes.push(0xe0 | (code >> 12), 0x80 | ((code >> 6) & 0x3f), 0x80 | (code & 0x3f));
+        } else {
+            bytes.push(0xf0 | (code >> 18), 0x80 | ((code >> 12) & 0x3f), 0x80 | ((code >> 6) & 0x3f), 0x80 | (code & 0x3f));
+        }
+    }
+    return bytes;
+}
+
+const SHA256_K = [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+];
+
+function sha256(bytes) {
+    // Padding: 0x80, zeros, then the length in bits as a 64-bit big endian integer
+    let length = bytes.length;
+    let padded = new Uint8Array(Math.ceil((length + 9) / 64) * 64);
+    padded.set(bytes);
+    padded[length] = 0x80;
+    let view = new DataView(padded.buffer);
+    view.setUint32(padded.length - 8, Math.floor(length / 0x20000000));
+    view.setUint32(padded.length - 4, (length * 8) >>> 0);
+
+    let h = [0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19];
+    let w = new Uint32Array(64);
+    const rotr = (x, n) => (x >>> n) | (x << (32 - n));
+    for (let offset = 0; offset < padded.length; offset += 64) {
+        for (let i = 0; i < 16; i++) {
+            w[i] = view.getUint32(offset + i * 4);
+        }
+        for (let i = 16; i < 64; i++) {
+            let s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+            let s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+            w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+        }
 
-    let process_input = std.fdopen(in_write_fd, "w");
-    process_input.puts(input);
-    process_input.flush();
-    process_input.close();
+        let [a, b, c, d, e, f, g, hh] = h;
+        for (let i = 0; i < 64; i++) {
+            let t1 = hh + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i];
+            let t2 = (rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c));
+            hh = g;
+            g = f;
+            f = e;
+            e = (d + t1) | 0;
+            d = c;
+            c = b;
+            b = a;
+            a = (t1 + t2) | 0;
+        }
+        h = [a, b, c, d, e, f, g, hh].map((x, i) => (h[i] + x) >>> 0);
+    }
 
-    let process_output = std.fdopen(out_read_fd, "r");
-    let output = process_output.readAsString();
-    process_output.close();
+    let digest = new Uint8Array(32);
+    let digestView = new DataView(digest.buffer);
+    h.forEach((x, i) => digestView.setUint32(i * 4, x));
+    return digest;
+}
 
-    os.waitpid(proc);
+const BASE32_ALPHABET = "abcdefghijklmnopqrstuvwxyz234567";
 
+// Lowercase RFC 4648 base32, without padding
+function base32(bytes) {
+    let output = "";
+    let buffer = 0;
+    let bits = 0;
+    for (const byte of bytes) {
+        buffer = (buffer << 8) | byte;
+        bits += 8;
+        while (bits >= 5) {
+            output += BASE32_ALPHABET[(buffer >>> (bits - 5)) & 31];
+            bits -= 5;
+        }
+        buffer &= (1 << bits) - 1;
+    }
+    if (bits > 0) {
+        output += BASE32_ALPHABET[(buffer << (5 - bits)) & 31];
+    }
     return output;
 }
 
+// Same as `hashRecipe.sh`: the first 160 bits of the SHA-256, as 32 base32 characters
+function hashString(str) {
+    return base32(sha256(utf8Encode(str)).subarray(0, 20));
+}
+
+function deepFreeze(obj) {
+    Object.values(obj).forEach((val) => {
+        if (val !== null && typeof val === "object" && !Object.isFrozen(val)) {
+            deepFreeze(val);
+        }
+    });
+    return Object.freeze(obj);
+}
+
+// Metadata is frozen once built, so its hash can be remembered per object.
+// Separately built but identical metadata (e.g. the same dependency of several recipes) is hashed once too.
+const metadataHashes = new WeakMap();
+const jsonHashes = new Map();
+
+function hashMetadata(metadata) {
+    let hash = metadataHashes.get(metadata);
+    if (hash === undefined) {
+        let json = sortedJsonStringify(metadata);
+        hash = jsonHashes.get(json);
+        if (hash === undefined) {
+            hash = hashString(json);
+            jsonHashes.set(json, hash);
+        }
+        if (Object.isFrozen(metadata)) {
+            metadataHashes.set(metadata, hash);
+        }
+    }
+    return hash;
+}
+
 // Source: https://gist.github.com/ahtcx/0cd94e62691f539160b32ecda18af3d6#gistcomment-3889214
 function deep_merge(source, target) {
     for (const [key, val] of Object.entries(source)) {
@@ -60,7 +162,10 @@ function deep_merge(source, target) {
 }
 
 export class Repo {
-    constructor(common_recipes = true) {
+    // With `stream`, every recipe and system is printed as a newline-delimited JSON record as soon as it's added
+    // (and not kept around), instead of the whole repo at once by `toString()`
+    constructor(common_recipes = true, stream = false) {
+        this.stream = stream;
         this.named_recipes = {};
         this.recipes = {};
         this.named_systems = {};
@@ -71,19 +176,31 @@ export class Repo {
         }
     }
 
+    emit(record) {
+        if (this.stream) {
+            console.log(sortedJsonStringify(record));
+        }
+    }
+
     addRecipe(recipe, unique_name = false) {
         if (typeof recipe === "function") {
             recipe = recipe({});
         }
-        this.recipes[`${recipe.metadata.name}@${recipe.hash()}`] = recipe.metadata;
-        Object.values(recipe.subrecipes).forEach((subrecipe) => {
-            this.addRecipe(subrecipe);
-        });
+        let id = `${recipe.metadata.name}@${recipe.hash()}`;
+        // Its subrecipes were added along with it
+        if (!this.recipes.hasOwnProperty(id)) {
+            this.recipes[id] = this.stream ? true : recipe.metadata;
+            this.emit({type: "recipe", id, metadata: recipe.metadata});
+            Object.values(recipe.subrecipes).forEach((subrecipe) => {
+                this.addRecipe(subrecipe);
+            });
+        }
         if (unique_name) {
             if (this.named_recipes.hasOwnProperty(recipe.metadata.name)) {
                 throw "Duplicate recipe name marked as 'unique_name'";
             }
             this.named_recipes[recipe.metadata.name] = recipe.hash();
+            this.emit({type: "named_recipe", name: recipe.metadata.name, hash: recipe.hash()});
         }
     }
 
@@ -93,20 +210,31 @@ export class Repo {
         }
 
         // Add all recipes not already added to the repo
-        system.metadata.packages = system.metadata.packages.map((recipe) => {
-            if (typeof recipe === "function") {
-                recipe = recipe({});
-            }
-            this.addRecipe(recipe);
-            return `${recipe.metadata.name}@${recipe.hash()}`;
+        system = new System({
+            ...system.metadata,
+            packages: system.metadata.packages.map((recipe) => {
+                if (typeof recipe === "function") {
+                    recipe = recipe({});
+                }
+                if (typeof recipe === "string") {
+                    return recipe;
+                }
+                this.addRecipe(recipe);
+                return `${recipe.metadata.name}@${recipe.hash()}`;
+            }),
         });
 
-        this.systems[`${system.metadata.name}@${system.hash()}`] = system.metadata;
+        let id = `${system.metadata.name}@${system.hash()}`;
+        if (!this.systems.hasOwnProperty(id)) {
+            this.systems[id] = this.stream ? true : system.metadata;
+            this.emit({type: "system", id, metadata: system.metadata});
+        }
         if (unique_name) {
             if (this.named_systems.hasOwnProperty(system.metadata.name)) {
                 throw "Duplicate system name marked as 'unique_name' (hint: pass 'false' as the second argument to addSystem)";
             }
             this.named_systems[system.metadata.name] = system.hash();
+            this.emit({type: "named_system", name: system.metadata.name, hash: system.hash()});
         }
     }
 
@@ -159,10 +287,11 @@ export class Recipe {
         }));
 
         this.recipe = metadata.recipe;
+        deepFreeze(metadata);
     }
 
     hash() {
-        return run_cmd(['./bold_unstable/hashRecipe.sh'], sortedJsonStringify(this.metadata)).trim();
+        return hashMetadata(this.metadata);
     }
 
     override(updates) {
@@ -177,10 +306,13 @@ export class Recipe {
 export class System {
     constructor(metadata) {
         this.metadata = metadata;
+        if (metadata.packages.every((recipe) => typeof recipe === "string")) {
+            deepFreeze(metadata);
+        }
     }
 
     hash() {
-        return run_cmd(['./bold_unstable/hashRecipe.sh'], sortedJsonStringify(this.metadata)).trim();
+        return hashMetadata(this.metadata);
     }
 
     override(updates) {
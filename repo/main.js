@@ -1,7 +1,8 @@
 import {Repo, System} from "./bold_unstable/utils.js";
 import * as apps from "./bold_unstable/apps.js";
 
-const repo = new Repo();
+// Recipes and systems are printed as they are added
+const repo = new Repo(true, true);
 
 // Add custom recipes below
 // Example: repo.addRecipe(apps.hello_sh({ message: "Foo bar!" }).override({ name: "hello_sh2" }));
@@ -34,5 +35,3 @@ repo.addSystem(new System({
         user: {},
     },
 }));
-
-console.log(repo.toString());